@@ -0,0 +1,176 @@
+"""
+Benchmark of plot_routes on synthetic graphs, results are saved as JSON to compare runs across commits.
+
+    python benchmarks/bench_plot_routes.py --sizes 20 --sizes 50 --output results.json
+"""
+from __future__ import annotations
+
+import json
+import platform
+import subprocess
+import tracemalloc
+
+from datetime import datetime
+from statistics import median
+from time import perf_counter
+
+import click
+import matplotlib
+import numpy as np
+
+matplotlib.use("Agg")
+
+from matplotlib.collections import LineCollection
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from flowmapviz.batch import build_segments, pack_densities
+from flowmapviz.geometry import EdgeGeometryIndex
+from flowmapviz.plot import WidthStyle, create_width_collection, get_width_polygons, plot_routes
+from flowmapviz.profiling import profile
+from flowmapviz.zoom import get_zoom_level, plot_graph_with_zoom
+
+from synthetic import grid_graph, random_frame, random_geometric_graph
+
+GRAPHS = {
+    "grid": lambda size: grid_graph(size),
+    "geometric": lambda size: random_geometric_graph(size * size),
+}
+
+
+def create_axes(geometry_index):
+    fig = Figure(figsize=(8, 8), dpi=100)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes((0, 0, 1, 1))
+    plot_graph_with_zoom(None, ax, geometry_index=geometry_index)
+    ax.apply_aspect()
+    return fig, ax
+
+
+def time_stages(g, geometry_index, frame, width_style, roadtypes_by_zoom, shared_index):
+    """
+    :return: seconds spent by geometry building, artist creation, whole plot_routes and Agg draw,
+        stages of plot_routes reported by the profiler
+    """
+    nodes_from, nodes_to, densities = frame
+    fig, ax = create_axes(geometry_index)
+    fig.canvas.draw()
+
+    # the same stages as in plot_routes, timed separately
+    start = perf_counter()
+    index = geometry_index if shared_index else EdgeGeometryIndex.from_graph(g, zip(nodes_from, nodes_to))
+    values, offsets = pack_densities(densities)
+    zoom_level = get_zoom_level(ax) if roadtypes_by_zoom else None
+    lines, color_scalars, line_widths, edges, styled, _ = build_segments(
+        index, nodes_from, nodes_to, values, offsets, boxed_width=width_style == WidthStyle.BOXED,
+        zoom_level=zoom_level)
+    path = None
+    if width_style in (WidthStyle.CALLIGRAPHY, WidthStyle.EQUIDISTANT):
+        path = get_width_polygons(ax, index, edges[styled], values, offsets, styled, 10, 50, 1,
+                                  equidistant=width_style == WidthStyle.EQUIDISTANT)
+    geometry = perf_counter() - start
+
+    start = perf_counter()
+    coll = LineCollection(lines)
+    coll.set_linewidth(line_widths)
+    coll.set_array(color_scalars)
+    if path is not None:
+        create_width_collection(path)
+    artists = perf_counter() - start
+
+    with profile() as profiler:
+        start = perf_counter()
+        plot_routes(g, ax, nodes_from, nodes_to, densities, width_style=width_style,
+                    roadtypes_by_zoom=roadtypes_by_zoom, geometry_index=geometry_index if shared_index else None)
+        total = perf_counter() - start
+    stages = {name: stage["time"] for name, stage in profiler.totals["stages"].items()}
+
+    start = perf_counter()
+    fig.canvas.draw()
+    draw = perf_counter() - start
+    return geometry, artists, total, draw, stages
+
+
+def peak_memory(g, geometry_index, frame, width_style, roadtypes_by_zoom, shared_index):
+    """
+    :return: peak of memory allocated by plot_routes in bytes
+    """
+    fig, ax = create_axes(geometry_index)
+    tracemalloc.start()
+    plot_routes(g, ax, *frame, width_style=width_style, roadtypes_by_zoom=roadtypes_by_zoom,
+                geometry_index=geometry_index if shared_index else None)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def get_metadata(repeat):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "commit": commit or None,
+        "date": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "matplotlib": matplotlib.__version__,
+        "machine": platform.machine(),
+        "repeat": repeat,
+    }
+
+
+@click.command()
+@click.option("--graphs", multiple=True, type=click.Choice(list(GRAPHS)), default=list(GRAPHS),
+              help="kinds of synthetic graphs")
+@click.option("--sizes", multiple=True, type=int, default=(20, 50), help="graphs have about size x size nodes")
+@click.option("--segments", type=float, default=0.3, help="part of edges of the graph in one frame")
+@click.option("--repeat", type=int, default=5, help="number of timed runs, median is reported")
+@click.option("--output", type=click.Path(dir_okay=False), default="benchmark.json")
+def main(graphs, sizes, segments, repeat, output):
+    results = []
+    for kind in graphs:
+        for size in sizes:
+            g = GRAPHS[kind](size)
+            start = perf_counter()
+            geometry_index = EdgeGeometryIndex.from_graph(g)
+            index_build = perf_counter() - start
+            frames = [random_frame(g, int(g.number_of_edges() * segments), seed=i) for i in range(repeat)]
+
+            for width_style in WidthStyle:
+                for roadtypes_by_zoom in (False, True):
+                    for shared_index in (False, True):
+                        timings = [time_stages(g, geometry_index, frame, width_style, roadtypes_by_zoom, shared_index)
+                                   for frame in frames]
+                        geometry, artists, total, draw = (median(t) for t in list(zip(*timings))[:4])
+                        stages = {name: median(t[4].get(name, 0.0) for t in timings) for name in timings[0][4]}
+                        result = {
+                            "graph": kind,
+                            "nodes": g.number_of_nodes(),
+                            "edges": g.number_of_edges(),
+                            "segments": len(frames[0][0]),
+                            "width_style": width_style.name,
+                            "roadtypes_by_zoom": roadtypes_by_zoom,
+                            "geometry_index": shared_index,
+                            "index_build": index_build,
+                            "geometry": geometry,
+                            "artists": artists,
+                            "plot_routes": total,
+                            "draw": draw,
+                            "stages": stages,
+                            "peak_memory": peak_memory(g, geometry_index, frames[0], width_style,
+                                                       roadtypes_by_zoom, shared_index),
+                        }
+                        results.append(result)
+                        print(f"{kind:>9} {result['edges']:>7} {width_style.name:>11} zoom={roadtypes_by_zoom:d} "
+                              f"index={shared_index:d}  geometry {geometry * 1000:8.2f} ms  "
+                              f"artists {artists * 1000:7.2f} ms  plot_routes {total * 1000:8.2f} ms  "
+                              f"draw {draw * 1000:8.2f} ms  peak {result['peak_memory'] / 2 ** 20:6.1f} MiB")
+
+    with open(output, "w") as f:
+        json.dump({"metadata": get_metadata(repeat), "results": results}, f, indent=2)
+    print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
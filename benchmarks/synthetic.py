@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import random
+
+import networkx as nx
+import numpy as np
+
+from shapely.geometry import LineString
+
+HIGHWAYS = ['motorway', 'trunk', 'primary', 'secondary', 'tertiary', 'residential', 'service']
+
+# about 200 m in degrees, so zoom levels of a plotted graph are realistic
+STEP = 0.002
+
+
+def grid_graph(size: int, seed: int = 0) -> nx.MultiDiGraph:
+    """
+    Square grid of size x size nodes with edges in both directions
+    """
+    positions = {i * size + j: (14.4 + j * STEP, 50.0 + i * STEP) for i in range(size) for j in range(size)}
+    pairs = [(i * size + j, i * size + j + 1) for i in range(size) for j in range(size - 1)]
+    pairs += [(i * size + j, (i + 1) * size + j) for i in range(size - 1) for j in range(size)]
+    return _create_graph(positions, pairs, seed)
+
+
+def random_geometric_graph(nodes: int, seed: int = 0) -> nx.MultiDiGraph:
+    """
+    Random geometric graph with about the same density of nodes as grid_graph
+    """
+    side = np.sqrt(nodes)
+    geometric = nx.random_geometric_graph(nodes, 1.5 / side, seed=seed)
+    positions = {n: (14.4 + x * side * STEP, 50.0 + y * side * STEP) for n, (x, y) in geometric.nodes(data="pos")}
+    return _create_graph(positions, list(geometric.edges()), seed)
+
+
+def random_frame(g: nx.MultiDiGraph, segments: int, seed: int = 0, max_density: int = 60):
+    """
+    :return: nodes_from, nodes_to and densities of randomly chosen edges of g
+    """
+    rnd = random.Random(seed)
+    edges = rnd.sample(list(g.edges()), min(segments, g.number_of_edges()))
+    nodes_from = [u for u, _ in edges]
+    nodes_to = [v for _, v in edges]
+    densities = [[rnd.randint(0, max_density) for _ in range(rnd.randint(1, 8))] for _ in edges]
+    return nodes_from, nodes_to, densities
+
+
+def _create_graph(positions, pairs, seed):
+    rnd = random.Random(seed)
+    g = nx.MultiDiGraph(crs='epsg:4326')
+    for n, (x, y) in positions.items():
+        g.add_node(n, x=x, y=y)
+
+    for a, b in pairs:
+        for u, v in ((a, b), (b, a)):
+            (xu, yu), (xv, yv) = positions[u], positions[v]
+            points = [(xu, yu)]
+            for t in np.linspace(0, 1, rnd.randint(1, 6) + 2)[1:-1]:
+                points.append((xu + (xv - xu) * t + rnd.uniform(-STEP, STEP) / 8,
+                               yu + (yv - yu) * t + rnd.uniform(-STEP, STEP) / 8))
+            points.append((xv, yv))
+            g.add_edge(u, v, length=rnd.uniform(100, 300), highway=rnd.choice(HIGHWAYS),
+                       geometry=LineString(points))
+    return g
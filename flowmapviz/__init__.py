@@ -1,3 +1,62 @@
-from .plot import plot_routes, WidthStyle
-from .preprocessing import map_distance_to_point_units
-from .zoom import get_zoom_level, ZoomLevel, plot_graph_with_zoom
+from importlib import import_module
+from typing import TYPE_CHECKING
+
+# submodules are imported on the first access of their names, so importing the package is cheap
+_EXPORTS = {
+    "BackgroundCache": "background",
+    "EdgeGeometryIndex": "geometry",
+    "load_graphml_index": "geometry",
+    "iter_keyframes": "keyframes",
+    "DensityFrame": "frame",
+    "DensityStatistics": "statistics",
+    "plot_routes": "plot",
+    "plot_frame": "plot",
+    "WidthStyle": "plot",
+    "FlowFrameRenderer": "renderer",
+    "FrameStore": "storage",
+    "map_distance_to_point_units": "preprocessing",
+    "get_zoom_level": "zoom",
+    "ZoomLevel": "zoom",
+    "plot_graph_with_zoom": "zoom",
+    "render_frames": "video",
+    "render_stream": "video",
+    "iter_frames": "video",
+    "TileGrid": "tiles",
+    "render_tiles": "tiles",
+    "render_tiled_image": "tiles",
+}
+
+__all__ = list(_EXPORTS)
+
+if TYPE_CHECKING:
+    from .background import BackgroundCache
+    from .geometry import EdgeGeometryIndex, load_graphml_index
+    from .keyframes import iter_keyframes
+    from .frame import DensityFrame
+    from .statistics import DensityStatistics
+    from .plot import plot_routes, plot_frame, WidthStyle
+    from .renderer import FlowFrameRenderer
+    from .storage import FrameStore
+    from .preprocessing import map_distance_to_point_units
+    from .zoom import get_zoom_level, ZoomLevel, plot_graph_with_zoom
+    from .video import render_frames, render_stream, iter_frames
+    from .tiles import TileGrid, render_tiles, render_tiled_image
+
+
+_SUBMODULES = ("background", "batch", "frame", "geometry", "keyframes", "plot", "preprocessing", "profiling",
+               "renderer", "statistics", "storage", "tiles", "video", "zoom")
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        # importing a submodule sets it as an attribute of the package
+        return import_module(f".{name}", __name__)
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(f".{_EXPORTS[name]}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__) | set(_SUBMODULES))
@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+
+from matplotlib.axes import Axes
+
+from .zoom import get_zoom_level
+
+
+class BackgroundCache:
+    """
+    Rasterized figure without its animated artists (densities of FlowFrameRenderer with animated=True),
+    cached by zoom level, view extent and figure size of the map.
+    A frame then only restores the background and draws the densities over it instead of redrawing the whole map.
+    The least recently used backgrounds are dropped when the cache is full.
+    """
+
+    def __init__(self, ax: Axes, max_size: int = 8):
+        """
+        :param ax: ax with the base map, its view defines the background
+        :param max_size: maximal number of cached backgrounds
+        """
+        self.ax = ax
+        self.max_size = max_size
+        self._backgrounds = OrderedDict()
+
+    def get_key(self):
+        """
+        :return: zoom level, view extent and figure size (in pixels) of the current view
+        """
+        return (get_zoom_level(self.ax), tuple(self.ax.get_xlim()), tuple(self.ax.get_ylim()),
+                tuple(self.ax.figure.bbox.size))
+
+    def capture(self):
+        """
+        Save the background of the current view, the canvas must have been drawn before
+        """
+        key = self.get_key()
+        canvas = self.ax.figure.canvas
+        self._backgrounds[key] = canvas.copy_from_bbox(self.ax.figure.bbox)
+        self._backgrounds.move_to_end(key)
+        while len(self._backgrounds) > self.max_size:
+            self._backgrounds.popitem(last=False)
+
+    def restore(self) -> bool:
+        """
+        Restore the background of the current view into the canvas
+        :return: False if the background is not cached, the figure has to be drawn and captured then
+        """
+        key = self.get_key()
+        background = self._backgrounds.get(key)
+        if background is None:
+            return False
+
+        self._backgrounds.move_to_end(key)
+        self.ax.figure.canvas.restore_region(background)
+        return True
+
+    def clear(self):
+        self._backgrounds.clear()
+
+    def __len__(self):
+        return len(self._backgrounds)
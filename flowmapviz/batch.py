@@ -0,0 +1,474 @@
+from __future__ import annotations
+
+from itertools import chain
+from weakref import WeakKeyDictionary
+
+import numpy as np
+
+from .geometry import EdgeGeometryIndex
+from .zoom import ZoomLevel
+
+# most items kept in the interpolation tables of one geometry index, the tables are cleared when they would exceed it
+TABLE_CACHE_SIZE = 2 ** 18
+# interpolation tables of geometry indices
+_interpolation_tables = WeakKeyDictionary()
+
+
+def pack_densities(densities: list[int] | list[list[int]]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Transforms densities of segments into one flat array of values and offsets of segments in it
+    :return: values (int32 if all densities are integers, float64 otherwise) and offsets
+    """
+    lengths = np.fromiter((1 if np.ndim(d) == 0 else len(d) for d in densities), dtype=np.int64,
+                          count=len(densities))
+    offsets = np.zeros(len(densities) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    values = np.fromiter(chain.from_iterable((d,) if np.ndim(d) == 0 else d for d in densities),
+                         dtype=np.float64, count=offsets[-1])
+    return compact_values(values), offsets
+
+
+def compact_values(values: np.ndarray) -> np.ndarray:
+    """
+    :return: values as int32 if they all are integers in its range (counts of cars), otherwise unchanged
+    """
+    int32 = np.iinfo(np.int32)
+    if len(values) and not (values.min() >= int32.min and values.max() <= int32.max
+                            and np.array_equal(values, np.trunc(values))):
+        return values
+    return values.astype(np.int32)
+
+
+def interpolate_ragged(values: np.ndarray, offsets: np.ndarray, owners: np.ndarray, positions: np.ndarray):
+    """
+    Equivalent of np.interp(positions, np.arange(m), values[offsets[s]:offsets[s + 1]])
+    evaluated for many segments at once
+    :param values: flat array of values of all segments
+    :param offsets: start of each segment in values, last item is the length of values
+    :param owners: index of the segment for each position
+    :param positions: non-negative positions in the segment values
+    """
+    starts = offsets[owners]
+    last = offsets[owners + 1] - 1 - starts
+
+    index = np.minimum(positions.astype(np.int64), last)
+    beyond = positions >= last
+    following = np.minimum(index + 1, last)
+
+    values = np.asarray(values, dtype=np.float64)
+    lower = values[starts + index]
+    slope = values[starts + following] - lower
+    result = slope * (positions - index) + lower
+    result[beyond] = lower[beyond]
+    return result
+
+
+def spread_positions(counts: np.ndarray, bins: np.ndarray):
+    """
+    For every segment s generate positions j * bins[s] / counts[s] for j in range(counts[s]),
+    equivalent of np.interp(np.arange(counts[s]), [0, counts[s]], [0, bins[s]])
+    :return: owning segment and position of each generated item
+    """
+    owners = np.repeat(np.arange(len(counts)), counts)
+    starts = np.zeros(len(counts), dtype=np.int64)
+    np.cumsum(counts[:-1], out=starts[1:])
+    steps = np.arange(len(owners)) - starts[owners]
+
+    slopes = bins / counts.astype(np.float64)
+    return owners, slopes[owners] * steps
+
+
+def gather_lines(geometry_index: EdgeGeometryIndex, edges: np.ndarray) -> np.ndarray:
+    """
+    :return: array of lines (defined by START and END point) of all edges concatenated in order
+    """
+    starts = geometry_index.offsets[edges]
+    counts = geometry_index.offsets[edges + 1] - starts - 1
+
+    line_starts = np.zeros(len(edges), dtype=np.int64)
+    np.cumsum(counts[:-1], out=line_starts[1:])
+    points = np.repeat(starts - line_starts, counts) + np.arange(counts.sum())
+
+    coords = geometry_index.coords
+    return np.stack((coords[points], coords[points + 1]), axis=1)
+
+
+def gather_points(geometry_index: EdgeGeometryIndex, edges: np.ndarray):
+    """
+    :return: coordinates of all edges concatenated in order, start of each edge in them
+    """
+    starts = geometry_index.offsets[edges]
+    counts = geometry_index.offsets[edges + 1] - starts
+
+    point_offsets = np.zeros(len(edges) + 1, dtype=np.int64)
+    np.cumsum(counts, out=point_offsets[1:])
+    points = np.repeat(starts - point_offsets[:-1], counts) + np.arange(point_offsets[-1])
+    return geometry_index.coords[points], point_offsets
+
+
+def gather_chains(geometry_index: EdgeGeometryIndex, edges: np.ndarray, starts: np.ndarray):
+    """
+    Coordinates of chains of edges, the shared point of following edges is not repeated
+    :param edges: edges of all chains concatenated
+    :param starts: start of each chain in edges, last item is the length of edges
+    :return: coordinates of all chains concatenated in order, start of each chain in them
+    """
+    coords, point_offsets = gather_points(geometry_index, edges)
+
+    joined = np.ones(len(edges), dtype=bool)
+    joined[starts[:-1]] = False
+    keep = np.ones(len(coords), dtype=bool)
+    keep[point_offsets[:-1][joined]] = False
+
+    chain_offsets = np.zeros(len(starts), dtype=np.int64)
+    if len(edges):
+        np.cumsum(np.add.reduceat(keep.astype(np.int64), point_offsets[starts[:-1]]), out=chain_offsets[1:])
+    return coords[keep], chain_offsets
+
+
+class InterpolationTables:
+    """
+    Positions of interpolated items inside the values of one segment. They depend only on the number of items
+    and the number of density bins of the segment, so a table is computed once for each such pair and reused
+    by all frames, whatever segments they contain.
+    """
+
+    def __init__(self, max_size: int = TABLE_CACHE_SIZE):
+        """
+        :param max_size: most items kept in the tables, all tables are dropped when new ones would exceed it
+        """
+        self.max_size = max_size
+        self.size = 0
+        self.starts = {}
+        self.index = np.empty(0, dtype=np.int64)
+        self.step = np.empty(0, dtype=np.int64)
+        self.fraction = np.empty(0, dtype=np.float64)
+
+    def clear(self):
+        self.size = 0
+        self.starts.clear()
+
+    def get_starts(self, counts: np.ndarray, bins: np.ndarray) -> np.ndarray:
+        """
+        Tables of pairs seen for the first time are appended to index, step and fraction
+        :param counts: number of interpolated items of each segment
+        :param bins: number of density bins of each segment
+        :return: start of the table of each segment in index, step and fraction
+        """
+        keys = (counts.astype(np.int64) << 32) | bins.astype(np.int64)
+        pairs, inverse = np.unique(keys, return_inverse=True)
+        pairs = pairs.tolist()
+
+        missing = [key for key in pairs if key not in self.starts]
+        added_size = sum(key >> 32 for key in missing)
+        if missing and self.size + added_size > self.max_size:
+            # tables of the current pairs are created again, the tables of one frame are kept even above max_size
+            self.clear()
+            missing = pairs
+            added_size = sum(key >> 32 for key in missing)
+        if missing:
+            self._reserve(self.size + added_size)
+            for key in missing:
+                count = key >> 32
+                end = self.size + count
+                self.index[self.size:end], self.step[self.size:end], self.fraction[self.size:end] = \
+                    self._create(count, key & 0xFFFFFFFF)
+                self.starts[key] = self.size
+                self.size = end
+
+        return np.array([self.starts[key] for key in pairs], dtype=np.int64)[inverse]
+
+    def _reserve(self, size: int):
+        """
+        Grow the arrays to at least size items, their capacity doubles so appending is amortized
+        """
+        if size <= len(self.index):
+            return
+        capacity = max(size, 2 * len(self.index), 1024)
+        for name in ("index", "step", "fraction"):
+            array = getattr(self, name)
+            grown = np.empty(capacity, dtype=array.dtype)
+            grown[:self.size] = array[:self.size]
+            setattr(self, name, grown)
+
+    @staticmethod
+    def _create(count: int, bins: int):
+        """
+        :return: index of the value below each item, step to the value above it and the position between them,
+            the same as interpolate_ragged of the positions of spread_positions
+        """
+        positions = (bins / np.float64(count)) * np.arange(count)
+        last = bins - 1
+        index = np.minimum(positions.astype(np.int64), last)
+        fraction = positions - index
+        fraction[positions >= last] = 0
+        return index, np.minimum(index + 1, last) - index, fraction
+
+
+def get_interpolation_tables(geometry_index: EdgeGeometryIndex) -> InterpolationTables:
+    """
+    :return: interpolation tables of the index, created once and kept while the index exists
+    """
+    tables = _interpolation_tables.get(geometry_index)
+    if tables is None:
+        tables = _interpolation_tables[geometry_index] = InterpolationTables()
+    return tables
+
+
+class InterpolationPlan:
+    """
+    Indices and weights of interpolate_ragged for given segments, their number of density bins and items,
+    so interpolating values of a frame is a single gather and blend
+    """
+
+    def __init__(self, lower: np.ndarray, upper: np.ndarray, fraction: np.ndarray):
+        """
+        :param lower: index of the value below each item in flat values
+        :param upper: index of the value above each item in flat values
+        :param fraction: position of each item between the lower and upper value
+        """
+        self.lower = lower
+        self.upper = upper
+        self.fraction = fraction
+
+    @classmethod
+    def create(cls,
+               counts: np.ndarray,
+               offsets: np.ndarray,
+               segments: np.ndarray,
+               tables: InterpolationTables = None) -> InterpolationPlan:
+        """
+        Plan assembled from the tables of the (number of items, number of bins) pairs of the segments
+        :param counts: number of interpolated items of each segment
+        :param offsets: start of each frame segment in values, last item is the length of values
+        :param segments: index of the frame segment (into offsets) of each interpolated segment
+        :param tables: tables reused between frames (see get_interpolation_tables), if None they are created
+        """
+        if tables is None:
+            tables = InterpolationTables()
+        table_starts = tables.get_starts(counts, np.diff(offsets)[segments])
+        item_starts = np.zeros(len(counts), dtype=np.int64)
+        np.cumsum(counts[:-1], out=item_starts[1:])
+        items = np.repeat(table_starts - item_starts, counts) + np.arange(counts.sum())
+
+        lower = np.repeat(offsets[segments], counts) + tables.index[items]
+        return cls(lower, lower + tables.step[items], tables.fraction[items])
+
+    def apply(self, values: np.ndarray) -> np.ndarray:
+        """
+        :return: values interpolated to all items, the same as interpolate_ragged
+        """
+        values = np.asarray(values, dtype=np.float64)
+        lower = values[self.lower]
+        return (values[self.upper] - lower) * self.fraction + lower
+
+
+def get_color_scalars(geometry_index: EdgeGeometryIndex, edges: np.ndarray,
+                      values: np.ndarray, offsets: np.ndarray, segments: np.ndarray):
+    """
+    Densities interpolated to every line of edges, the same way as in plot_route
+    :param segments: index of the frame segment (into offsets) of each edge
+    """
+    line_counts = np.diff(geometry_index.offsets)[edges] - 1
+    tables = get_interpolation_tables(geometry_index)
+    return InterpolationPlan.create(line_counts, offsets, segments, tables).apply(values)
+
+
+def get_point_densities(geometry_index: EdgeGeometryIndex, edges: np.ndarray,
+                        values: np.ndarray, offsets: np.ndarray, segments: np.ndarray):
+    """
+    Densities interpolated to every point of edges, the same way as in plot_route
+    :param segments: index of the frame segment (into offsets) of each edge
+    """
+    point_counts = np.diff(geometry_index.offsets)[edges]
+    tables = get_interpolation_tables(geometry_index)
+    return InterpolationPlan.create(point_counts, offsets, segments, tables).apply(values)
+
+
+def select_segments(geometry_index: EdgeGeometryIndex,
+                    nodes_from: np.ndarray,
+                    nodes_to: np.ndarray,
+                    zoom_level: ZoomLevel = None,
+                    hidden_lines_width: float = 1,
+                    view: tuple[float, float, float, float] = None):
+    """
+    Split segments of a frame into those plotted with full style and those hidden by zoom level
+    :param view: if set, segments outside of this area (min x, min y, max x, max y) are skipped
+    :return: edge of each segment (-1 if not found), indices of styled segments, indices of hidden segments,
+             number of segments which are not plotted (segments outside of view are not counted)
+    """
+    edges = geometry_index.lookup(nodes_from, nodes_to)
+    found = edges >= 0
+
+    styled = found.copy()
+    hidden = np.zeros_like(found)
+    if zoom_level is not None:
+        styled[found] = geometry_index.get_visible_mask(zoom_level)[edges[found]]
+        if hidden_lines_width != 0:
+            hidden = found & ~styled
+
+    false_segments = len(edges) - np.count_nonzero(styled) - np.count_nonzero(hidden)
+
+    if view is not None:
+        plotted = styled | hidden
+        plotted[plotted] = geometry_index.get_view_mask(edges[plotted], view)
+        styled &= plotted
+        hidden &= plotted
+
+    return edges, np.flatnonzero(styled), np.flatnonzero(hidden), false_segments
+
+
+def get_density_bins(values: np.ndarray, offsets: np.ndarray, min_density: float, max_density: float, bins: int):
+    """
+    Split the range from min_density to max_density into equal bins (densities outside of it fall into
+    the first or last one) and find the bin of each segment
+    :return: bin of each segment, -1 if densities of the segment are not all in the same bin
+    """
+    result = np.full(len(offsets) - 1, -1, dtype=np.int64)
+    if not len(values):
+        return result
+
+    if max_density > min_density:
+        value_bins = np.floor((values - min_density) / (max_density - min_density) * bins)
+        value_bins = np.clip(value_bins, 0, bins - 1).astype(np.int64)
+    else:
+        value_bins = np.zeros(len(values), dtype=np.int64)
+
+    starts = np.minimum(offsets[:-1], len(values) - 1)
+    lowest = np.minimum.reduceat(value_bins, starts)
+    highest = np.maximum.reduceat(value_bins, starts)
+    same = (lowest == highest) & (np.diff(offsets) > 0)
+    result[same] = lowest[same]
+    return result
+
+
+def merge_segments(nodes_from: np.ndarray, nodes_to: np.ndarray,
+                   values: np.ndarray, offsets: np.ndarray,
+                   segments: np.ndarray, bins: np.ndarray):
+    """
+    Chain segments following each other in the frame (node_to of a segment is node_from of the next one)
+    which are in the same density bin
+    :param segments: indices of plotted segments, only those are merged
+    :param bins: bin of each segment of the frame (see get_density_bins), segments with -1 are not merged
+    :return: segments of all chains concatenated, start of each chain in them (last item is their count),
+             mean density of each chain, segments which are not in any chain
+    """
+    nodes_from = np.asarray(nodes_from)
+    nodes_to = np.asarray(nodes_to)
+
+    mergeable = np.zeros(len(bins), dtype=bool)
+    mergeable[segments] = bins[segments] >= 0
+    linked = mergeable[:-1] & mergeable[1:] & (nodes_to[:-1] == nodes_from[1:]) & (bins[:-1] == bins[1:])
+
+    member = np.zeros(len(bins), dtype=bool)
+    member[:-1] |= linked
+    member[1:] |= linked
+    chained = np.flatnonzero(member)
+
+    first = chained == 0
+    first[~first] = ~linked[chained[~first] - 1]
+    starts = np.append(np.flatnonzero(first), len(chained))
+
+    # values of a chain are contiguous, sum them at once
+    value_starts = offsets[chained[starts[:-1]]]
+    value_ends = offsets[chained[starts[1:] - 1] + 1]
+    bounds = np.column_stack((value_starts, value_ends)).ravel()
+    sums = np.add.reduceat(np.append(values, 0), bounds)[::2] if len(bounds) else np.empty(0)
+    densities = sums / (value_ends - value_starts)
+
+    return chained, starts, densities, segments[~member[segments]]
+
+
+def get_line_widths(color_scalars: np.ndarray,
+                    min_width_density: int, max_width_density: int,
+                    default_linewidth: float, width_modifier: float,
+                    boxed_width: bool):
+    if boxed_width:
+        return np.interp(color_scalars, [min_width_density, max_width_density],
+                         [default_linewidth, default_linewidth + width_modifier])
+    return np.full(len(color_scalars), default_linewidth)
+
+
+def build_segments(geometry_index: EdgeGeometryIndex,
+                   nodes_from: np.ndarray,
+                   nodes_to: np.ndarray,
+                   values: np.ndarray,
+                   offsets: np.ndarray,
+                   min_width_density: int = 10, max_width_density: int = 50,
+                   default_linewidth: float = 3, width_modifier: float = 1,
+                   boxed_width: bool = True,
+                   zoom_level: ZoomLevel = None,
+                   hidden_lines_width: float = 1,
+                   view: tuple[float, float, float, float] = None):
+    """
+    Batched equivalent of plotting every segment with plot_route
+    :param geometry_index: coordinates of edges
+    :param nodes_from: OSM id defining starting nodes of segments
+    :param nodes_to: OSM id defining ending nodes of segments
+    :param values: densities of all segments concatenated
+    :param offsets: start of each segment in values, last item is the length of values
+    :param boxed_width: if True line widths represent the density (WidthStyle.BOXED)
+    :param zoom_level: if set, segments with highway type not plotted at this level are hidden
+    :param hidden_lines_width: width of hidden segments, if 0 hidden segments are not plotted
+    :param view: if set, segments outside of this area (min x, min y, max x, max y) are skipped
+    :return: lines, color scalars, line widths, edge of each segment (-1 if not found),
+             indices of segments plotted with full style, number of segments which were not plotted
+    """
+    edges, styled, hidden, false_segments = select_segments(geometry_index, nodes_from, nodes_to,
+                                                            zoom_level, hidden_lines_width, view)
+
+    lines = gather_lines(geometry_index, edges[styled])
+    color_scalars = get_color_scalars(geometry_index, edges[styled], values, offsets, styled)
+    line_widths = get_line_widths(color_scalars, min_width_density, max_width_density,
+                                  default_linewidth, width_modifier, boxed_width)
+
+    if len(hidden):
+        hidden_scalars = get_color_scalars(geometry_index, edges[hidden], values, offsets, hidden)
+        lines = np.concatenate((lines, gather_lines(geometry_index, edges[hidden])))
+        line_widths = np.concatenate((line_widths, np.full(len(hidden_scalars), hidden_lines_width)))
+        color_scalars = np.concatenate((color_scalars, hidden_scalars))
+
+    return lines, color_scalars, line_widths, edges, styled, false_segments
+
+
+def build_merged_segments(geometry_index: EdgeGeometryIndex,
+                          nodes_from: np.ndarray,
+                          nodes_to: np.ndarray,
+                          values: np.ndarray,
+                          offsets: np.ndarray,
+                          bins: np.ndarray,
+                          min_width_density: int = 10, max_width_density: int = 50,
+                          default_linewidth: float = 3, width_modifier: float = 1,
+                          boxed_width: bool = True,
+                          zoom_level: ZoomLevel = None,
+                          hidden_lines_width: float = 1,
+                          view: tuple[float, float, float, float] = None):
+    """
+    build_segments with chains of styled segments (see merge_segments) plotted as single paths
+    colored by their mean density, other segments are plotted the same way as by build_segments
+    :param bins: density bin of each segment (see get_density_bins)
+    :return: paths (lines of segments not in chains, chains, lines of hidden segments), color scalars,
+             line widths, edge of each segment (-1 if not found), indices of segments plotted with full style,
+             number of segments which were not plotted, indices of styled segments not in chains,
+             coordinates of chains, start of each chain in them and density of each chain
+    """
+    edges, styled, hidden, false_segments = select_segments(geometry_index, nodes_from, nodes_to,
+                                                            zoom_level, hidden_lines_width, view)
+    chained, starts, chain_densities, single = merge_segments(nodes_from, nodes_to, values, offsets, styled, bins)
+    chain_coords, chain_offsets = gather_chains(geometry_index, edges[chained], starts)
+
+    paths = list(gather_lines(geometry_index, edges[single]))
+    paths += np.split(chain_coords, chain_offsets[1:-1]) if len(chain_densities) else []
+    color_scalars = np.concatenate((get_color_scalars(geometry_index, edges[single], values, offsets, single),
+                                    chain_densities))
+    line_widths = get_line_widths(color_scalars, min_width_density, max_width_density,
+                                  default_linewidth, width_modifier, boxed_width)
+
+    if len(hidden):
+        hidden_scalars = get_color_scalars(geometry_index, edges[hidden], values, offsets, hidden)
+        paths += list(gather_lines(geometry_index, edges[hidden]))
+        line_widths = np.concatenate((line_widths, np.full(len(hidden_scalars), hidden_lines_width)))
+        color_scalars = np.concatenate((color_scalars, hidden_scalars))
+
+    return (paths, color_scalars, line_widths, edges, styled, false_segments,
+            single, chain_coords, chain_offsets, chain_densities)
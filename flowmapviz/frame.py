@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+import numpy as np
+
+from .batch import pack_densities
+
+
+class DensityFrame:
+    """
+    Segments of one frame with their densities as a ragged array,
+    densities of segment s are values[offsets[s]:offsets[s + 1]].
+    Arrays are not copied, so a frame read from a FrameStore is only a view into its memory-mapped columns.
+    """
+
+    __slots__ = ("nodes_from", "nodes_to", "values", "offsets")
+
+    def __init__(self, nodes_from: np.ndarray, nodes_to: np.ndarray, values: np.ndarray, offsets: np.ndarray):
+        """
+        :param nodes_from: OSM id defining starting nodes of segments
+        :param nodes_to: OSM id defining ending nodes of segments
+        :param values: densities of all segments concatenated (e.g. int32 counts of cars)
+        :param offsets: start of each segment in values, last item is the length of values
+        """
+        self.nodes_from = np.asarray(nodes_from, dtype=np.int64)
+        self.nodes_to = np.asarray(nodes_to, dtype=np.int64)
+        self.values = np.asarray(values)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+        if not (len(self.nodes_from) == len(self.nodes_to) == len(self.offsets) - 1):
+            raise ValueError(f"Frame has {len(self.nodes_from)} nodes_from, {len(self.nodes_to)} nodes_to "
+                             f"and {len(self.offsets) - 1} segments of densities")
+        if self.offsets[-1] > len(self.values):
+            raise ValueError(f"Offsets of densities exceed {len(self.values)} values")
+
+    @classmethod
+    def from_lists(cls,
+                   nodes_from: list[int],
+                   nodes_to: list[int],
+                   densities: list[int] | list[list[int]]) -> DensityFrame:
+        """
+        Frame of segments in the format of plot_routes
+        """
+        values, offsets = pack_densities(densities)
+        return cls(nodes_from, nodes_to, values, offsets)
+
+    def get_densities(self) -> list[np.ndarray]:
+        """
+        :return: densities of each segment
+        """
+        if not len(self):
+            return []
+        return np.split(self.values[self.offsets[0]:self.offsets[-1]], self.offsets[1:-1] - self.offsets[0])
+
+    def __len__(self):
+        return len(self.nodes_from)
@@ -0,0 +1,385 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import networkx as nx
+import numpy as np
+import shapely
+
+from .zoom import get_highway_class, get_highway_types, ZoomLevel
+
+_ARRAYS = ("node_ids", "node_x", "node_y", "edge_keys", "offsets", "coords", "highway",
+           "map_offsets", "map_coords", "map_highway")
+
+# vertices closer than this part of a pixel to the simplified line are dropped
+LOD_PIXEL_TOLERANCE = 0.5
+# resolution the simplification tolerance of zoom levels is computed for
+LOD_DPI = 100
+# directory of indices of GraphML maps cached by load_graphml_index
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "flowmapviz")
+# size of the parts of a GraphML file at its start and end hashed into its cache key
+_CACHE_KEY_BLOCK = 2 ** 20
+# version of the saved arrays, snapshots of an older version are not found in the cache
+_CACHE_VERSION = 2
+
+
+class EdgeGeometryIndex:
+    """
+    Coordinates of graph edges packed into contiguous arrays.
+    Built once from the graph and reused for every frame, so fetching segment coordinates
+    is an array lookup instead of graph traversal and shapely calls.
+
+    Only the shortest of parallel edges is stored for each (node_from, node_to) pair for looking up segments.
+    All edges, parallel ones included, are stored separately for plotting the map.
+    """
+
+    def __init__(self,
+                 node_ids: np.ndarray,
+                 node_x: np.ndarray,
+                 node_y: np.ndarray,
+                 edge_keys: np.ndarray,
+                 offsets: np.ndarray,
+                 coords: np.ndarray,
+                 highway: np.ndarray,
+                 map_offsets: np.ndarray,
+                 map_coords: np.ndarray,
+                 map_highway: np.ndarray,
+                 highway_classes: tuple[str, ...],
+                 crs: str = None):
+        """
+        :param node_ids: sorted OSM ids of nodes
+        :param node_x: x coordinates of nodes in order of node_ids
+        :param node_y: y coordinates of nodes in order of node_ids
+        :param edge_keys: sorted packed (node_from, node_to) keys of edges, see pack_keys
+        :param offsets: start of each edge in coords, last item is the length of coords
+        :param coords: float64 array of shape (N, 2) with coordinates of all edges
+        :param highway: index of the highway class of each edge, -1 if the edge has none
+        :param map_offsets: start of each edge of the map in map_coords, last item is the length of map_coords
+        :param map_coords: float64 array of shape (M, 2) with coordinates of all edges of the map
+            (parallel edges included) in order of osmnx.plot_graph
+        :param map_highway: index of the highway class of each edge of the map, -1 if the edge has none
+        :param highway_classes: names of highway classes
+        :param crs: coordinate reference system of the graph
+        """
+        self.node_ids = node_ids
+        self.node_x = node_x
+        self.node_y = node_y
+        self.edge_keys = edge_keys
+        self.offsets = offsets
+        self.coords = coords
+        self.highway = highway
+        self.map_offsets = map_offsets
+        self.map_coords = map_coords
+        self.map_highway = map_highway
+        self.highway_classes = tuple(highway_classes)
+        self.crs = crs
+        self.path = None
+        self._zoom_masks = {}
+        self._bounds = None
+        self._map_bounds = None
+        self._lods = {}
+
+    @classmethod
+    def from_graph(cls, g: nx.MultiDiGraph, edges=None) -> EdgeGeometryIndex:
+        """
+        :param g: Graph representation of base layer map
+        :param edges: if set, only (node_from, node_to) pairs from edges are included
+        """
+        nodes_from = []
+        nodes_to = []
+        geometries = []
+        highway_names = []
+        map_geometries = []
+        map_highway_names = []
+        for u, v, parallel_edges in _iter_edge_pairs(g, edges):
+            shortest = None
+            for data in parallel_edges.values():
+                if "geometry" in data:
+                    xs, ys = data["geometry"].xy
+                    geometry = np.column_stack((xs, ys))
+                else:
+                    geometry = np.array(((g.nodes[u]["x"], g.nodes[u]["y"]),
+                                         (g.nodes[v]["x"], g.nodes[v]["y"])), dtype=np.float64)
+                map_geometries.append(geometry)
+                map_highway_names.append(get_highway_class(data.get("highway")))
+                if shortest is None or data["length"] < shortest[0]["length"]:
+                    shortest = data, geometry
+
+            data, geometry = shortest
+            geometries.append(geometry)
+            highway_names.append(get_highway_class(data.get("highway")))
+            nodes_from.append(u)
+            nodes_to.append(v)
+
+        nodes = g.nodes if edges is None else dict.fromkeys(nodes_from + nodes_to)
+        node_ids = np.fromiter(nodes, dtype=np.int64, count=len(nodes))
+        order = np.argsort(node_ids)
+        node_ids = node_ids[order]
+        node_x = np.fromiter((g.nodes[n]["x"] for n in nodes), dtype=np.float64, count=len(nodes))[order]
+        node_y = np.fromiter((g.nodes[n]["y"] for n in nodes), dtype=np.float64, count=len(nodes))[order]
+
+        highway_classes = sorted({h for h in map_highway_names if h is not None})
+        class_codes = {h: i for i, h in enumerate(highway_classes)}
+        highway = np.array([class_codes.get(h, -1) for h in highway_names], dtype=np.int32)
+        map_highway = np.array([class_codes.get(h, -1) for h in map_highway_names], dtype=np.int32)
+
+        edge_keys = pack_keys(node_ids,
+                              np.searchsorted(node_ids, np.array(nodes_from, dtype=np.int64)),
+                              np.searchsorted(node_ids, np.array(nodes_to, dtype=np.int64)))
+        order = np.argsort(edge_keys)
+
+        lengths = np.array([len(c) for c in geometries], dtype=np.int64)[order]
+        offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        coords = np.concatenate([geometries[i] for i in order]) if len(order) else np.empty((0, 2))
+
+        map_offsets = np.zeros(len(map_geometries) + 1, dtype=np.int64)
+        np.cumsum([len(c) for c in map_geometries], out=map_offsets[1:])
+        map_coords = np.concatenate(map_geometries) if map_geometries else np.empty((0, 2))
+
+        crs = g.graph.get("crs")
+        return cls(node_ids, node_x, node_y, edge_keys[order], offsets,
+                   np.ascontiguousarray(coords, dtype=np.float64), highway[order],
+                   map_offsets, np.ascontiguousarray(map_coords, dtype=np.float64), map_highway,
+                   tuple(highway_classes), crs=None if crs is None else str(crs))
+
+    def save(self, path: str):
+        """
+        Save the index as a directory of .npy files, see load
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in _ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(path, "metadata.json"), "w") as f:
+            json.dump({"highway_classes": list(self.highway_classes), "crs": self.crs}, f)
+
+    @classmethod
+    def load(cls, path: str, mmap_mode: str = "r") -> EdgeGeometryIndex:
+        """
+        Open an index saved by save. With mmap_mode the arrays are memory-mapped read-only,
+        so processes loading the same index share its memory through the page cache
+        and pickling the index passes only its path.
+        """
+        with open(os.path.join(path, "metadata.json")) as f:
+            metadata = json.load(f)
+        arrays = [np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode) for name in _ARRAYS]
+
+        index = cls(*arrays, tuple(metadata["highway_classes"]), crs=metadata["crs"])
+        if mmap_mode is not None:
+            index.path = path
+        return index
+
+    def __reduce__(self):
+        if self.path is not None:
+            return self.load, (self.path,)
+        return self.__class__, tuple(getattr(self, name) for name in _ARRAYS) + (self.highway_classes, self.crs)
+
+    def __len__(self):
+        return len(self.edge_keys)
+
+    def lookup(self, nodes_from, nodes_to) -> np.ndarray:
+        """
+        Find edges defined by their starting and ending nodes
+        :return: index of each edge, -1 for edges that are not in the graph
+        """
+        nodes_from = np.asarray(nodes_from, dtype=np.int64)
+        nodes_to = np.asarray(nodes_to, dtype=np.int64)
+
+        u, u_found = self._node_index(nodes_from)
+        v, v_found = self._node_index(nodes_to)
+        keys = pack_keys(self.node_ids, u, v)
+
+        edges = np.searchsorted(self.edge_keys, keys)
+        edges[edges == len(self.edge_keys)] = 0
+        found = u_found & v_found
+        if len(self.edge_keys):
+            found &= self.edge_keys[edges] == keys
+        else:
+            found[:] = False
+
+        return np.where(found, edges, -1)
+
+    def get_coordinates(self, edge: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        :return: x and y coordinates of the edge geometry
+        """
+        coords = self.coords[self.offsets[edge]:self.offsets[edge + 1]]
+        return coords[:, 0], coords[:, 1]
+
+    def get_visible_mask(self, zoom_level: ZoomLevel) -> np.ndarray:
+        """
+        :return: bool array marking edges with highway type plotted at zoom_level (or with no highway type)
+        """
+        mask = self._zoom_masks.get(zoom_level)
+        if mask is None:
+            allowed = [i for i, h in enumerate(self.highway_classes) if h in get_highway_types(zoom_level)]
+            mask = (self.highway == -1) | np.isin(self.highway, allowed)
+            self._zoom_masks[zoom_level] = mask
+        return mask
+
+    def get_bounds(self) -> np.ndarray:
+        """
+        :return: bounding boxes of edges as an array of shape (E, 4) with min x, min y, max x, max y
+        """
+        if self._bounds is None:
+            self._bounds = _get_bounds(self.offsets, self.coords)
+        return self._bounds
+
+    def get_map_bounds(self) -> np.ndarray:
+        """
+        :return: bounding boxes of edges of the map in the same form as get_bounds
+        """
+        if self._map_bounds is None:
+            self._map_bounds = _get_bounds(self.map_offsets, self.map_coords)
+        return self._map_bounds
+
+    def get_view_mask(self, edges: np.ndarray, view: tuple[float, float, float, float]) -> np.ndarray:
+        """
+        :param edges: indices of edges
+        :param view: min x, min y, max x, max y of the visible area
+        :return: bool array marking edges whose bounding box intersects view
+        """
+        x_min, y_min, x_max, y_max = view
+        bounds = self.get_bounds()[edges]
+        return ((bounds[:, 0] <= x_max) & (bounds[:, 2] >= x_min) &
+                (bounds[:, 1] <= y_max) & (bounds[:, 3] >= y_min))
+
+    def get_simplified(self, zoom_level: ZoomLevel) -> EdgeGeometryIndex:
+        """
+        Level of detail of edges for zoom_level, geometries are simplified (Douglas-Peucker) with tolerance
+        of LOD_PIXEL_TOLERANCE pixels at the largest scale of the zoom level, computed once and cached
+        :return: index with the same edges and simplified coordinates, self for the last zoom level
+        """
+        tolerance = get_lod_tolerance(zoom_level)
+        if not tolerance or not len(self):
+            return self
+
+        lod = self._lods.get(zoom_level)
+        if lod is None:
+            lines = shapely.linestrings(self.coords, indices=np.repeat(np.arange(len(self)), np.diff(self.offsets)))
+            simplified = shapely.simplify(lines, tolerance, preserve_topology=False)
+            # degenerated edges (e.g. all points the same) are kept as they are
+            lines = np.where(shapely.get_num_coordinates(simplified) >= 2, simplified, lines)
+            coords, owners = shapely.get_coordinates(lines, return_index=True)
+
+            offsets = np.zeros(len(self) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(owners, minlength=len(self)), out=offsets[1:])
+            lod = EdgeGeometryIndex(self.node_ids, self.node_x, self.node_y, self.edge_keys, offsets,
+                                    np.ascontiguousarray(coords, dtype=np.float64), self.highway,
+                                    self.map_offsets, self.map_coords, self.map_highway,
+                                    self.highway_classes, crs=self.crs)
+            lod._zoom_masks = self._zoom_masks
+            self._lods[zoom_level] = lod
+        return lod
+
+    def select(self, edges: np.ndarray, map_edges: np.ndarray) -> EdgeGeometryIndex:
+        """
+        :param edges: sorted indices of edges
+        :param map_edges: indices of edges of the map
+        :return: index of only the given edges (e.g. edges of one map tile), nodes are shared with self
+        """
+        offsets, coords = _select_geometries(self.offsets, self.coords, edges)
+        map_offsets, map_coords = _select_geometries(self.map_offsets, self.map_coords, map_edges)
+        return EdgeGeometryIndex(self.node_ids, self.node_x, self.node_y, self.edge_keys[edges], offsets, coords,
+                                 self.highway[edges], map_offsets, map_coords, self.map_highway[map_edges],
+                                 self.highway_classes, crs=self.crs)
+
+    def _node_index(self, nodes):
+        index = np.searchsorted(self.node_ids, nodes)
+        index[index == len(self.node_ids)] = 0
+        found = self.node_ids[index] == nodes if len(self.node_ids) else np.zeros(len(nodes), dtype=bool)
+        return index, found
+
+
+def load_graphml_index(path: str, cache_dir: str = CACHE_DIR) -> EdgeGeometryIndex:
+    """
+    Geometry index of a GraphML map. The first load parses the file and saves the index into cache_dir,
+    next loads of the same file only open the memory-mapped snapshot.
+    :param cache_dir: directory of cached indices, if None the file is always parsed
+    """
+    if cache_dir is None:
+        return _load_graphml(path)
+
+    cached = os.path.join(cache_dir, get_graphml_cache_key(path))
+    if os.path.isdir(cached):
+        return EdgeGeometryIndex.load(cached)
+
+    index = _load_graphml(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    # saved aside and renamed, so an interrupted save or a concurrent load never sees a partial snapshot
+    partial = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        index.save(partial)
+        os.replace(partial, cached)
+    except OSError:
+        # saved by another process in the meantime
+        shutil.rmtree(partial, ignore_errors=True)
+    return EdgeGeometryIndex.load(cached)
+
+
+def get_graphml_cache_key(path: str) -> str:
+    """
+    :return: hash of the snapshot version, size, modification time and content at the start and end of the file
+    """
+    stat = os.stat(path)
+    key = hashlib.sha256(f"{_CACHE_VERSION}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    with open(path, "rb") as f:
+        key.update(f.read(_CACHE_KEY_BLOCK))
+        f.seek(max(stat.st_size - _CACHE_KEY_BLOCK, 0))
+        key.update(f.read(_CACHE_KEY_BLOCK))
+    return key.hexdigest()
+
+
+def _load_graphml(path):
+    import osmnx as ox
+    return EdgeGeometryIndex.from_graph(ox.load_graphml(path))
+
+
+def get_lod_tolerance(zoom_level: ZoomLevel) -> float:
+    """
+    :return: map distance of LOD_PIXEL_TOLERANCE pixels at the largest scale of zoom_level (see get_zoom_level)
+    """
+    map_distance_per_inch = zoom_level.value / (111 * 39370.0787)
+    return map_distance_per_inch / LOD_DPI * LOD_PIXEL_TOLERANCE
+
+
+def _iter_edge_pairs(g, edges=None):
+    if edges is None:
+        for u, neighbours in g.adj.items():
+            for v, parallel_edges in neighbours.items():
+                yield u, v, parallel_edges
+        return
+
+    for u, v in dict.fromkeys(edges):
+        parallel_edges = g.get_edge_data(u, v)
+        if parallel_edges is not None:
+            yield u, v, parallel_edges
+
+
+def _get_bounds(offsets, coords):
+    bounds = np.empty((len(offsets) - 1, 4), dtype=np.float64)
+    if len(bounds):
+        starts = offsets[:-1]
+        bounds[:, :2] = np.minimum.reduceat(coords, starts)
+        bounds[:, 2:] = np.maximum.reduceat(coords, starts)
+    return bounds
+
+
+def _select_geometries(offsets, coords, edges):
+    starts = offsets[edges]
+    counts = offsets[edges + 1] - starts
+    selected_offsets = np.zeros(len(edges) + 1, dtype=np.int64)
+    np.cumsum(counts, out=selected_offsets[1:])
+    points = np.repeat(starts - selected_offsets[:-1], counts) + np.arange(selected_offsets[-1])
+    return selected_offsets, coords[points]
+
+
+def pack_keys(node_ids: np.ndarray, index_from: np.ndarray, index_to: np.ndarray) -> np.ndarray:
+    """
+    Pack pairs of node indices into single int64 keys
+    """
+    return np.asarray(index_from, dtype=np.int64) * len(node_ids) + np.asarray(index_to, dtype=np.int64)
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+from typing import Iterable, Iterator
+
+import numpy as np
+
+from .batch import interpolate_ragged, spread_positions
+from .frame import DensityFrame
+
+
+class KeyframeBlend:
+    """
+    Segments of two consecutive keyframes matched and resampled to the same number of densities once,
+    so an in-between frame is only a blend of two arrays. The in-between frames have the same segments
+    in the same order, FlowFrameRenderer then updates only colors and widths of its collections.
+
+    Segments missing in one of the keyframes have zero densities in it, so they fade in or out.
+    """
+
+    def __init__(self, start: DensityFrame, end: DensityFrame):
+        """
+        :param start: keyframe at t = 0
+        :param end: keyframe at t = 1
+        """
+        in_start, in_end = match_segments(start, end)
+        start_counts = _gather(np.diff(start.offsets), in_start)
+        end_counts = _gather(np.diff(end.offsets), in_end)
+        counts = np.maximum(start_counts, end_counts)
+
+        # every segment is in at least one of the keyframes
+        only_end = in_start < 0
+        self.nodes_from = _gather(start.nodes_from, in_start)
+        self.nodes_from[only_end] = end.nodes_from[in_end[only_end]]
+        self.nodes_to = _gather(start.nodes_to, in_start)
+        self.nodes_to[only_end] = end.nodes_to[in_end[only_end]]
+        self.offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        self.start_values = _resample(start, in_start, start_counts, counts)
+        self.end_values = _resample(end, in_end, end_counts, counts)
+
+    def get_frame(self, t: float) -> DensityFrame:
+        """
+        :param t: position between the keyframes, 0 is the start and 1 the end keyframe
+        :return: frame with densities blended linearly
+        """
+        values = (1 - t) * self.start_values + t * self.end_values
+        return DensityFrame(self.nodes_from, self.nodes_to, values, self.offsets)
+
+    def __len__(self):
+        return len(self.nodes_from)
+
+
+def match_segments(start: DensityFrame, end: DensityFrame) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Match segments of two frames by their nodes, the n-th occurrence of a segment in start
+    is matched with its n-th occurrence in end
+    :return: index in start and index in end (-1 if missing) of each segment of both frames,
+        segments of start are first in their order followed by segments only in end
+    """
+    nodes_from = np.concatenate((start.nodes_from, end.nodes_from))
+    nodes_to = np.concatenate((start.nodes_to, end.nodes_to))
+    occurrences = np.concatenate((_get_occurrences(start.nodes_from, start.nodes_to),
+                                  _get_occurrences(end.nodes_from, end.nodes_to)))
+    in_end = np.arange(len(nodes_from)) >= len(start)
+
+    # the same segment of both frames is sorted next to each other, start first
+    order = np.lexsort((in_end, occurrences, nodes_to, nodes_from))
+    same = ((nodes_from[order[1:]] == nodes_from[order[:-1]]) & (nodes_to[order[1:]] == nodes_to[order[:-1]])
+            & (occurrences[order[1:]] == occurrences[order[:-1]]))
+    matched_start = order[:-1][same]
+    matched_end = order[1:][same] - len(start)
+
+    start_in_end = np.full(len(start), -1, dtype=np.int64)
+    start_in_end[matched_start] = matched_end
+    added = np.ones(len(end), dtype=bool)
+    added[matched_end] = False
+    added = np.flatnonzero(added)
+
+    in_start = np.concatenate((np.arange(len(start)), np.full(len(added), -1, dtype=np.int64)))
+    return in_start, np.concatenate((start_in_end, added))
+
+
+def iter_keyframes(frames: Iterable[tuple[object, DensityFrame]], steps: int) \
+        -> Iterator[tuple[object, DensityFrame]]:
+    """
+    Add frames blended from consecutive keyframes, e.g. to render a smooth video from coarse simulation output
+    :param frames: (timestamp, DensityFrame) of keyframes, see video.iter_frames
+    :param steps: number of frames from one keyframe to the next one, steps - 1 frames are added between them
+    :return: generator of (timestamp, DensityFrame) of keyframes and in-between frames,
+        timestamps of in-between frames are interpolated
+    """
+    previous = None
+    for timestamp, frame in frames:
+        if previous is not None:
+            previous_timestamp, previous_frame = previous
+            yield previous_timestamp, previous_frame
+            blend = KeyframeBlend(previous_frame, frame)
+            for step in range(1, steps):
+                t = step / steps
+                yield previous_timestamp + (timestamp - previous_timestamp) * t, blend.get_frame(t)
+        previous = timestamp, frame
+
+    if previous is not None:
+        yield previous
+
+
+def _get_occurrences(nodes_from, nodes_to):
+    """
+    :return: number of previous segments with the same nodes for each segment
+    """
+    order = np.lexsort((np.arange(len(nodes_from)), nodes_to, nodes_from))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (nodes_from[order[1:]] != nodes_from[order[:-1]]) | (nodes_to[order[1:]] != nodes_to[order[:-1]])
+    positions = np.arange(len(order))
+    group_starts = np.maximum.accumulate(np.where(first, positions, 0))
+
+    occurrences = np.empty(len(order), dtype=np.int64)
+    occurrences[order] = positions - group_starts
+    return occurrences
+
+
+def _gather(values, index):
+    """
+    :return: values at index, zero where index is -1
+    """
+    result = np.zeros(len(index), dtype=values.dtype)
+    found = index >= 0
+    result[found] = values[index[found]]
+    return result
+
+
+def _resample(frame, segments, counts, new_counts):
+    """
+    Densities of segments of frame interpolated to new_counts values each (the same way as plot_route
+    spreads them along a segment), segments missing in frame (-1) get zeros
+    """
+    values = np.zeros(new_counts.sum())
+    present = np.repeat(counts > 0, new_counts)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        owners, positions = spread_positions(new_counts, counts)
+    owners = owners[present]
+    if len(owners):
+        values[present] = interpolate_ragged(frame.values, frame.offsets, segments[owners], positions[present])
+    return values
@@ -6,15 +6,22 @@ from functools import cache
 import networkx as nx
 import numpy as np
 
-from matplotlib import pyplot as plt
+from matplotlib import colormaps
 from matplotlib.axes import Axes
-from matplotlib.collections import LineCollection, PatchCollection
+from matplotlib.collections import LineCollection, PathCollection
 from enum import Enum, unique
 
-from matplotlib.colors import ListedColormap
+from matplotlib.colors import ListedColormap, Normalize
+from matplotlib.path import Path
 
-from .preprocessing import get_width_polygon
-from .zoom import get_zoom_level, get_highway_types, ZoomLevel
+from .batch import build_merged_segments, build_segments, gather_points, get_density_bins, get_point_densities
+from .frame import DensityFrame
+from .geometry import EdgeGeometryIndex
+from . import profiling
+from .statistics import DensityStatistics
+from .preprocessing import get_polygons_from_calligraphy, get_polygons_from_equidistant, get_width_polygon, \
+    point_units_to_map_distance
+from .zoom import get_zoom_level, get_highway_class, get_highway_types, ZoomLevel
 
 
 @unique
@@ -29,14 +36,15 @@ class WidthStyle(Enum):
     """
     CALLIGRAPHY = 2
     """
-    uses matplotlib.fill_between / matplotlib.fill_betweenx
+    uses matplotlib.PathCollection
     """
     EQUIDISTANT = 3
     """
-    uses matplotlib.PatchCollection
+    uses matplotlib.PathCollection
     """
 
 
+@profiling.profiled_frame
 def plot_routes(g: nx.MultiDiGraph,
                 ax: Axes,
                 nodes_from: list[int],
@@ -48,10 +56,15 @@ def plot_routes(g: nx.MultiDiGraph,
                 width_style: WidthStyle = WidthStyle.BOXED,
                 round_edges: bool = True,
                 roadtypes_by_zoom: bool = False, hidden_lines_width = 1,
-                plot: bool = True):
+                plot: bool = True,
+                geometry_index: EdgeGeometryIndex = None,
+                cull_to_view: bool = False, view_margin: float = 0.1,
+                simplify: bool = False,
+                merge_bins: int = 0,
+                statistics: DensityStatistics = None):
     """
     Plotting of segments into ax with their density represented by color and width
-    :param g: Graph representation of base layer map
+    :param g: Graph representation of base layer map, may be None if geometry_index is set
     :param ax: layer for adding plotted shapes
     :param nodes_from: OSM id defining starting nodes of segments
     :param nodes_to: OSM id defining ending nodes of segments
@@ -66,92 +79,128 @@ def plot_routes(g: nx.MultiDiGraph,
     :param round_edges: if True plot circles at the end of wide segments for smoother connection
     :param plot: if True add collections to Ax
     :param roadtypes_by_zoom: if True filter segments based on the zoom level of ax
-    :return: LineCollection of color segments, PatchCollection of width representation
+    :param geometry_index: precomputed coordinates of edges of g, if set g is not searched for coordinates
+    :param cull_to_view: if True skip segments outside of the view limits of ax
+    :param view_margin: margin around the view limits as a fraction of their size, used with cull_to_view
+    :param simplify: if True use geometries simplified for the zoom level of ax (see EdgeGeometryIndex.get_simplified)
+    :param merge_bins: if set, density ranges are split into this number of bins and consecutive segments
+        (node_to of a segment is node_from of the next one) with all densities in the same bin are plotted
+        as one path of their mean density
+    :param statistics: statistics of the whole simulation (e.g. FrameStore.density_statistics), if set
+        min_density, max_density, min_width_density and max_width_density are derived from it
+        (see DensityStatistics.get_density_limits), so all frames are plotted with the same scales
+    :return: LineCollection of color segments, PathCollection of width representation
     """
-    lines = []
-    color_scalars = []
-    polygons = []
-    zoomed_lines = []
-    zoomed_color_scalars = []
-    false_segments = 0
-
     if not (len(nodes_from) == len(nodes_to) and len(nodes_to) == len(densities)):
         logging.error(f"Nodes_from, nodes_to and densities does not have the same length")
+        count = min(len(nodes_from), len(nodes_to), len(densities))
+        nodes_from, nodes_to, densities = nodes_from[:count], nodes_to[:count], densities[:count]
+
+    with profiling.stage("segments"):
+        frame = DensityFrame.from_lists(nodes_from, nodes_to, densities)
+
+    return plot_frame(g, ax, frame, min_density, max_density, min_width_density, max_width_density,
+                      default_linewidth, width_modifier, width_style, round_edges, roadtypes_by_zoom,
+                      hidden_lines_width, plot, geometry_index, cull_to_view, view_margin, simplify, merge_bins,
+                      statistics)
+
+
+@profiling.profiled_frame
+def plot_frame(g: nx.MultiDiGraph,
+               ax: Axes,
+               frame: DensityFrame,
+               min_density: int = 1, max_density: int = 10,
+               min_width_density: int = 10, max_width_density: int = 50,
+               default_linewidth: float = 3, width_modifier: float = 1,
+               width_style: WidthStyle = WidthStyle.BOXED,
+               round_edges: bool = True,
+               roadtypes_by_zoom: bool = False, hidden_lines_width=1,
+               plot: bool = True,
+               geometry_index: EdgeGeometryIndex = None,
+               cull_to_view: bool = False, view_margin: float = 0.1,
+               simplify: bool = False,
+               merge_bins: int = 0,
+               statistics: DensityStatistics = None):
+    """
+    plot_routes of a frame given as arrays, e.g. FrameStore.get_frame, other parameters are the same
+    :param frame: segments and their densities
+    :return: LineCollection of color segments, PathCollection of width representation
+    """
+    nodes_from, nodes_to, values, offsets = frame.nodes_from, frame.nodes_to, frame.values, frame.offsets
+    if statistics is not None:
+        min_density, max_density, min_width_density, max_width_density = statistics.get_density_limits()
+
+    if geometry_index is None:
+        with profiling.stage("geometry_index"):
+            geometry_index = EdgeGeometryIndex.from_graph(g, zip(nodes_from.tolist(), nodes_to.tolist()))
+    if simplify:
+        with profiling.stage("simplify"):
+            geometry_index = geometry_index.get_simplified(get_zoom_level(ax))
 
     # get zoom level
     zoom_level = get_zoom_level(ax) if roadtypes_by_zoom else None
-
-    for node_from, node_to, density in zip(nodes_from, nodes_to, densities):
-        if type(density) is int:
-            density = [density]
-
-        lines_new, color_scalars_new, polygons_new = plot_route(g, node_from, node_to, density, ax,
-                                                                min_width_density, max_width_density,
-                                                                width_modifier=width_modifier,
-                                                                width_style=width_style, round_edges=round_edges,
-                                                                zoom_level=zoom_level)
-        # get geometry data for smaller zoom
-        z_lines_new, z_colors_new = None, None
-        if zoom_level and hidden_lines_width != 0 and lines_new is None:
-            z_lines_new, z_colors_new, _ = plot_route(g, node_from, node_to, density, ax,
-                                                      min_width_density, max_width_density,
-                                                      width_modifier=width_modifier,
-                                                      width_style=None,
-                                                      zoom_level=None)
-
-        if lines_new is not None:
-            lines.append(lines_new)
-            color_scalars.append(color_scalars_new)
-            polygons.extend(polygons_new)
-        elif z_lines_new is not None:
-            zoomed_lines.append(z_lines_new)
-            zoomed_color_scalars.append(z_colors_new)
+    view = get_view_bounds(ax, view_margin, default_linewidth + width_modifier) if cull_to_view else None
+
+    with profiling.stage("segments"):
+        chains = None
+        if merge_bins:
+            bins = get_merge_bins(values, offsets, merge_bins, min_density, max_density,
+                                  min_width_density, max_width_density, width_style)
+            (lines, color_scalars, line_widths, edges, styled, false_segments,
+             single, *chains) = build_merged_segments(
+                geometry_index, nodes_from, nodes_to, values, offsets, bins,
+                min_width_density, max_width_density,
+                default_linewidth=default_linewidth, width_modifier=width_modifier,
+                boxed_width=width_style == WidthStyle.BOXED,
+                zoom_level=zoom_level, hidden_lines_width=hidden_lines_width, view=view)
+            profiling.count("merged_segments", len(styled) - len(single))
         else:
-            false_segments += 1
-
+            lines, color_scalars, line_widths, edges, styled, false_segments = build_segments(
+                geometry_index, nodes_from, nodes_to, values, offsets,
+                min_width_density, max_width_density,
+                default_linewidth=default_linewidth, width_modifier=width_modifier,
+                boxed_width=width_style == WidthStyle.BOXED,
+                zoom_level=zoom_level, hidden_lines_width=hidden_lines_width, view=view)
+            single = styled
+
+    profiling.count("segments", len(nodes_from))
+    profiling.count("styled_segments", len(styled))
+    profiling.count("false_segments", false_segments)
     if false_segments:
         logging.info(f"False segments: {false_segments} from {len(nodes_from)}")
 
-    if not lines:
+    if not len(styled):
         return None, None
 
-    color_scalars = np.hstack(color_scalars)
+    # width as filling
+    path = None
+    if width_style in (WidthStyle.CALLIGRAPHY, WidthStyle.EQUIDISTANT):
+        with profiling.stage("width_polygons"):
+            path = get_width_polygons(ax, geometry_index, edges[single], values, offsets, single,
+                                      min_width_density, max_width_density, width_modifier,
+                                      equidistant=width_style == WidthStyle.EQUIDISTANT,
+                                      round_edges=round_edges, chains=chains)
+
+    with profiling.stage("collections"):
+        # create collection
+        norm = Normalize(min_density, max_density)
+        coll = LineCollection(lines, cmap=get_cmap(), norm=norm)
+
+        coll.set_linewidth(line_widths)
+        coll.set_array(color_scalars)
+
+        if round_edges:
+            coll.set_capstyle('round')
 
-    # width in collection
-    if width_style == WidthStyle.BOXED:
-        line_widths = np.interp(color_scalars, [min_width_density, max_width_density],
-                                [default_linewidth, default_linewidth + width_modifier])
-    else:
-        line_widths = np.full(len(color_scalars), default_linewidth)
-
-    # add width for zoomed segments
-    if zoomed_color_scalars:
-        zoomed_color_scalars = np.hstack(zoomed_color_scalars)
-        arr = np.full(len(zoomed_color_scalars), hidden_lines_width)
-        line_widths = np.concatenate((line_widths, arr))
-        color_scalars = np.concatenate((color_scalars, zoomed_color_scalars))
-
-    # create collection
-    lines.extend(zoomed_lines)
-    lines = np.vstack(lines)
-    norm = plt.Normalize(min_density, max_density)
-    coll = LineCollection(lines, cmap=get_cmap(), norm=norm)
-
-    coll.set_linewidth(line_widths)
-    coll.set_array(color_scalars)
-
-    if round_edges:
-        coll.set_capstyle('round')
-
-    if plot:
-        ax.add_collection(coll, autolim=False)
-
-    patch = None
-    if polygons:
-        patch = PatchCollection(polygons)
-        patch.set_facecolor(get_cmap()(1.0))
         if plot:
-            ax.add_collection(patch, autolim=False)
+            ax.add_collection(coll, autolim=False)
+
+        patch = None
+        if path is not None and len(path.vertices):
+            patch = create_width_collection(path)
+            patch.set_facecolor(get_cmap()(1.0))
+            if plot:
+                ax.add_collection(patch, autolim=False)
 
     return coll, patch
 
@@ -166,35 +215,139 @@ def plot_route(g: nx.MultiDiGraph,
                width_modifier: float,
                width_style: WidthStyle | None,
                round_edges: bool = True,
-               zoom_level: ZoomLevel = None):
-    x, y = get_node_coordinates(g, node_from, node_to, zoom_level)
-    if not x or not y:
+               zoom_level: ZoomLevel = None,
+               geometry_index: EdgeGeometryIndex = None):
+    with profiling.stage("node_coordinates"):
+        x, y = get_node_coordinates(g, node_from, node_to, zoom_level, geometry_index)
+    if x is None or y is None:
         return None, None, None
 
-    # edit length of densities to match length of x
-    a = np.arange(len(x))
-    density_index = np.interp(a, [0, len(x)], [0, len(densities)])
-    point_densities = np.interp(density_index, np.arange(len(densities)), densities)
+    with profiling.stage("interpolation"):
+        # edit length of densities to match length of x
+        a = np.arange(len(x))
+        density_index = np.interp(a, [0, len(x)], [0, len(densities)])
+        point_densities = np.interp(density_index, np.arange(len(densities)), densities)
 
-    # color gradient
-    line = reshape(x, y)
-    density_index = np.interp(np.arange(len(line)), [0, len(line)], [0, len(densities)])
-    color_scalar = np.interp(density_index, np.arange(len(densities)), densities)
+        # color gradient
+        line = reshape(x, y)
+        density_index = np.interp(np.arange(len(line)), [0, len(line)], [0, len(densities)])
+        color_scalar = np.interp(density_index, np.arange(len(densities)), densities)
 
     # width as filling
     polygons = []
-    if width_style == WidthStyle.CALLIGRAPHY:
-        polygons = get_width_polygon(ax, x, y, point_densities, min_width_density, max_width_density,
-                                     width_modifier, equidistant=False, round_edges=round_edges)
+    with profiling.stage("width_polygons"):
+        if width_style == WidthStyle.CALLIGRAPHY:
+            polygons = get_width_polygon(ax, x, y, point_densities, min_width_density, max_width_density,
+                                         width_modifier, equidistant=False, round_edges=round_edges)
 
-    elif width_style == WidthStyle.EQUIDISTANT:
-        polygons = get_width_polygon(ax, x, y, point_densities, min_width_density, max_width_density,
-                                     width_modifier, equidistant=True, round_edges=round_edges)
+        elif width_style == WidthStyle.EQUIDISTANT:
+            polygons = get_width_polygon(ax, x, y, point_densities, min_width_density, max_width_density,
+                                         width_modifier, equidistant=True, round_edges=round_edges)
 
     return line, color_scalar, polygons
 
 
-def get_node_coordinates(g, node_from, node_to, zoom_level=None):
+def create_width_collection(path: Path):
+    """
+    Collection of the compound path of width polygons created by get_width_polygons, round edges included
+    """
+    return PathCollection([path], linewidths=0)
+
+
+def get_width_polygons(ax: Axes,
+                       geometry_index: EdgeGeometryIndex,
+                       edges: np.ndarray,
+                       values: np.ndarray,
+                       offsets: np.ndarray,
+                       segments: np.ndarray,
+                       min_width_density: int,
+                       max_width_density: int,
+                       width_modifier: float,
+                       equidistant: bool,
+                       round_edges: bool = True,
+                       chains: tuple[np.ndarray, np.ndarray, np.ndarray] = None) -> Path:
+    """
+    Width polygons of the selected segments, the same as plot_route creates for each of them,
+    built for all segments of a frame at once
+    :return: compound path of all polygons
+    :param edges: edges of the segments in geometry_index
+    :param segments: indices of segments in offsets
+    :param chains: coordinates, their offsets and densities of merged chains of segments
+        (see build_merged_segments), polygons of the chains are added
+    """
+    point_densities = get_point_densities(geometry_index, edges, values, offsets, segments)
+    coords, point_offsets = gather_points(geometry_index, edges)
+    if chains is not None:
+        chain_coords, chain_offsets, chain_densities = chains
+        coords = np.concatenate((coords, chain_coords))
+        point_offsets = np.concatenate((point_offsets, chain_offsets[1:] + point_offsets[-1]))
+        point_densities = np.concatenate((point_densities, np.repeat(chain_densities, np.diff(chain_offsets))))
+    return get_polygons_from_points(ax, coords, point_offsets, point_densities, min_width_density, max_width_density,
+                                    width_modifier, equidistant, round_edges)
+
+
+def get_polygons_from_points(ax: Axes,
+                             coords: np.ndarray,
+                             point_offsets: np.ndarray,
+                             point_densities: np.ndarray,
+                             min_width_density: int,
+                             max_width_density: int,
+                             width_modifier: float,
+                             equidistant: bool,
+                             round_edges: bool = True) -> Path:
+    """
+    Width polygons of lines given by their points
+    :param coords: coordinates of all lines concatenated
+    :param point_offsets: start of each line in coords, last item is the length of coords
+    :param point_densities: density at each point of coords
+    :return: compound path of all polygons
+    """
+    # the transform of ax is resolved once for all lines
+    map_width, _ = point_units_to_map_distance(width_modifier, ax)
+    widths = np.interp(point_densities, [min_width_density, max_width_density], [0, map_width])
+
+    if equidistant:
+        return get_polygons_from_equidistant(coords[:, 0], coords[:, 1], widths, point_offsets, round_edges)
+    return get_polygons_from_calligraphy(coords[:, 0], coords[:, 1], widths, point_offsets, round_edges)
+
+
+def get_merge_bins(values: np.ndarray, offsets: np.ndarray, merge_bins: int,
+                   min_density: int, max_density: int, min_width_density: int, max_width_density: int,
+                   width_style: WidthStyle):
+    """
+    Bin of each segment for merging, segments in the same bin have the same color and width bin
+    :return: bin of each segment, -1 if the segment can not be merged
+    """
+    bins = get_density_bins(values, offsets, min_density, max_density, merge_bins)
+    if width_style == WidthStyle.NONE:
+        return bins
+
+    width_bins = get_density_bins(values, offsets, min_width_density, max_width_density, merge_bins)
+    return np.where((bins >= 0) & (width_bins >= 0), bins * merge_bins + width_bins, -1)
+
+
+def get_view_bounds(ax: Axes, margin: float = 0.1, line_width: float = 0):
+    """
+    :param margin: margin around the view limits as a fraction of their size
+    :param line_width: the widest plotted line (in points), added to the margin
+    :return: min x, min y, max x, max y of the view limits of ax extended by the margin
+    """
+    (x_min, x_max), (y_min, y_max) = sorted(ax.get_xlim()), sorted(ax.get_ylim())
+    width_x, width_y = point_units_to_map_distance(line_width, ax)
+    margin_x = (x_max - x_min) * margin + abs(width_x)
+    margin_y = (y_max - y_min) * margin + abs(width_y)
+    return x_min - margin_x, y_min - margin_y, x_max + margin_x, y_max + margin_y
+
+
+def get_node_coordinates(g, node_from, node_to, zoom_level=None, geometry_index=None):
+    if geometry_index is not None:
+        edge = geometry_index.lookup([node_from], [node_to])[0]
+        if edge < 0:
+            return None, None
+        if zoom_level is not None and not geometry_index.get_visible_mask(zoom_level)[edge]:
+            return None, None
+        return geometry_index.get_coordinates(edge)
+
     x = []
     y = []
     edge = g.get_edge_data(node_from, node_to)
@@ -203,7 +356,7 @@ def get_node_coordinates(g, node_from, node_to, zoom_level=None):
 
     data = min(edge.values(), key=lambda d: d["length"])
     if 'highway' in data and zoom_level is not None:
-        if data['highway'] not in get_highway_types(zoom_level):
+        if get_highway_class(data['highway']) not in get_highway_types(zoom_level):
             return None, None
 
     if "geometry" in data:
@@ -228,6 +381,6 @@ def reshape(x, y):
 
 @cache
 def get_cmap():
-    cmap = plt.get_cmap('autumn_r', 512)
+    cmap = colormaps['autumn_r'].resampled(512)
     newcmp = ListedColormap(cmap(np.linspace(0.25, 1, 256)))
     return newcmp
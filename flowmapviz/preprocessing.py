@@ -1,9 +1,12 @@
 import numpy as np
-import matplotlib.patches as mp_patches
 from matplotlib.axes import Axes
 from matplotlib.patches import Circle
-from shapely.geometry import LineString
+from matplotlib.path import Path
 
+from . import profiling
+
+# vertices of Circle((0, 0), 1).get_verts(), circles of round edges are scaled and shifted copies of it
+UNIT_CIRCLE = Circle((0, 0), 1).get_verts()
 
 # ---------------------------------------------------------------------------------
 # Generic
@@ -17,6 +20,10 @@ def get_width_polygon(ax: Axes,
                       equidistant: bool = False,
                       round_edges: bool = True,
                       ):
+    """
+    Polygons representing width of the line
+    :return: vertex arrays of polygons
+    """
     width_modifier, wm2 = point_units_to_map_distance(width_modifier, ax)
     widths = np.interp(densities, [min_width_density, max_width_density], [0, width_modifier])
 
@@ -25,13 +32,14 @@ def get_width_polygon(ax: Axes,
     if widths.any() > 0:
 
         if round_edges:
-            polygons.extend(create_circle_endings(x, y, widths[0], widths[-1]))
+            polygons.extend(p.get_verts() for p in create_circle_endings(x, y, widths[0], widths[-1]))
 
         if equidistant:
-            patch = get_polygon_from_equidistant(x, y, widths)
-            polygons.append(patch)
+            polygon = get_polygon_from_equidistant(x, y, widths)
+            if polygon is not None:
+                polygons.append(polygon)
         else:
-            _ = plot_segment_line_width(ax, x, y, widths)
+            polygons.append(get_segment_line_width_vertices(x, y, widths))
 
     return polygons
 
@@ -41,6 +49,109 @@ def create_circle_endings(x, y, width_from, width_to):
     return patches
 
 
+def get_circle_polygons(x, y, radii):
+    """
+    Vertex arrays of many circles at once, the same as Circle.get_verts of each of them
+    :param x: x coords of centers
+    :param y: y coords of centers
+    :param radii: radius (in map distance) of each circle
+    :return: array of vertices of shape (number of circles, vertices of a circle, 2)
+    """
+    radii = np.asarray(radii, dtype=np.float64)[:, np.newaxis]
+    return np.stack((np.asarray(x, dtype=np.float64)[:, np.newaxis] + radii * UNIT_CIRCLE[:, 0],
+                     np.asarray(y, dtype=np.float64)[:, np.newaxis] + radii * UNIT_CIRCLE[:, 1]), axis=-1)
+
+
+def get_end_caps(x, y, widths, offsets, lines):
+    """
+    Circles at both ends of the selected lines (see create_circle_endings) built at once
+    :param lines: indices of lines in offsets
+    """
+    ends = np.column_stack((offsets[lines], offsets[lines + 1] - 1)).ravel()
+    return get_circle_polygons(np.asarray(x)[ends], np.asarray(y)[ends], np.asarray(widths)[ends])
+
+
+def get_lines_with_width(widths, offsets) -> np.ndarray:
+    """
+    :return: indices of lines with any non-zero width, only they get polygons
+    """
+    if not len(widths):
+        return np.empty(0, dtype=np.int64)
+    return np.flatnonzero(np.logical_or.reduceat(np.asarray(widths) != 0, offsets[:-1]))
+
+
+def get_side_polygons(side, other_side, offsets, lines):
+    """
+    Polygons of the selected lines going along one side of each line and back along the other side
+    :param side: coordinates of one side of all lines concatenated
+    :param other_side: coordinates of the other side of all lines concatenated
+    :param offsets: start of each line in side and other_side, last item is their length
+    :param lines: indices of lines in offsets
+    :return: vertices of all polygons concatenated, start of each polygon in them
+    """
+    starts = offsets[lines]
+    counts = offsets[lines + 1] - starts
+    polygon_offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+    np.cumsum(2 * counts, out=polygon_offsets[1:])
+
+    owners = np.repeat(np.arange(len(lines)), 2 * counts)
+    positions = np.arange(polygon_offsets[-1]) - polygon_offsets[owners]
+    back = positions >= counts[owners]
+    # the other side is reversed, so the polygon goes around the line
+    points = starts[owners] + np.where(back, 2 * counts[owners] - 1 - positions, positions)
+    vertices = np.where(back[:, np.newaxis], other_side[points], side[points])
+    return vertices, polygon_offsets
+
+
+def add_end_caps(vertices, polygon_offsets, x, y, widths, offsets, lines):
+    """
+    Append circles at both ends of the selected lines (see get_end_caps) to polygons
+    :return: vertices of all polygons concatenated, start of each polygon in them
+    """
+    caps = get_end_caps(x, y, widths, offsets, lines)
+    cap_offsets = polygon_offsets[-1] + np.arange(1, len(caps) + 1) * len(UNIT_CIRCLE)
+    return np.concatenate((vertices, caps.reshape(-1, 2))), np.concatenate((polygon_offsets, cap_offsets))
+
+
+def get_polygons_path(vertices, polygon_offsets) -> Path:
+    """
+    One compound path of many polygons, a single array of vertices and codes drawn at once.
+    The path is filled by the nonzero rule, so all polygons are turned counterclockwise,
+    otherwise overlapping polygons of opposite orientation would leave holes.
+    :param vertices: vertices of all polygons concatenated
+    :param polygon_offsets: start of each polygon in vertices, last item is the length of vertices,
+        polygons are not empty
+    """
+    if not len(vertices):
+        return Path(np.empty((0, 2)), np.empty(0, dtype=Path.code_type))
+    counts = np.diff(polygon_offsets)
+
+    # signed areas of polygons (shoelace formula), the next vertex of the last one is the first one
+    owners = np.repeat(np.arange(len(counts)), counts)
+    positions = np.arange(len(vertices)) - polygon_offsets[owners]
+    following = np.where(positions == counts[owners] - 1, polygon_offsets[owners], np.arange(len(vertices)) + 1)
+    # relative to the first vertex, map coordinates are large compared to the polygons
+    local = vertices - vertices[polygon_offsets[owners]]
+    cross = local[:, 0] * local[following, 1] - local[following, 0] * local[:, 1]
+    clockwise = (np.add.reduceat(cross, polygon_offsets[:-1]) < 0)[owners]
+    vertices = vertices[np.where(clockwise, polygon_offsets[owners] + counts[owners] - 1 - positions,
+                                 np.arange(len(vertices)))]
+
+    # every polygon is closed by a copy of its first vertex, as PolyCollection does
+    path_offsets = polygon_offsets + np.arange(len(polygon_offsets))
+    path_vertices = np.empty((len(vertices) + len(counts), 2))
+    closing = path_offsets[1:] - 1
+    is_vertex = np.ones(len(path_vertices), dtype=bool)
+    is_vertex[closing] = False
+    path_vertices[is_vertex] = vertices
+    path_vertices[closing] = vertices[polygon_offsets[:-1]]
+
+    codes = np.full(len(path_vertices), Path.LINETO, dtype=Path.code_type)
+    codes[path_offsets[:-1]] = Path.MOVETO
+    codes[closing] = Path.CLOSEPOLY
+    return Path(path_vertices, codes)
+
+
 def map_distance_to_point_units(map_distance: float, ax):
     lims = np.array([lim[1] - lim[0] for lim in (ax.get_xlim(), ax.get_ylim())])
     return map_distance * ax.get_window_extent().size / lims
@@ -55,101 +166,167 @@ def point_units_to_map_distance(value_in_points: float, ax):
 # Calligraphy
 
 
-def plot_segment_line_width(ax, x, y, widths):
+def get_polygons_from_calligraphy(x, y, widths, offsets, round_edges: bool = True) -> Path:
     """
-    Plot coloured line width around line either horizontally or vertically
+    Width polygons of many lines at once, the same as get_width_polygon creates
+    for each of them with equidistant=False, circles of round edges follow polygons of all lines
+    :param x: x coords of all lines concatenated
+    :param y: y coords of all lines concatenated
+    :param widths: width (in map distance) for each point
+    :param offsets: start of each line in x, y and widths, last item is their length
+    :return: compound path of all polygons, see get_polygons_path
     """
-    if abs(x[0] - x[-1]) > abs(y[0] - y[-1]):
-        y1 = np.add(y, widths)
-        y2 = np.subtract(y, widths)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    widths = np.asarray(widths, dtype=np.float64)
+    lines = get_lines_with_width(widths, offsets)
+
+    # lines are widened vertically if they go more horizontally than vertically, otherwise horizontally
+    starts, ends = offsets[:-1], offsets[1:] - 1
+    horizontal = np.repeat(np.abs(x[starts] - x[ends]) > np.abs(y[starts] - y[ends]), np.diff(offsets))
+    shift_x = np.where(horizontal, 0, widths)
+    shift_y = np.where(horizontal, widths, 0)
 
-        patch = ax.fill_between(x, y1, y2, alpha=1, linewidth=0, color='red')
-    else:
-        x1 = np.add(x, widths)
-        x2 = np.subtract(x, widths)
+    vertices, polygon_offsets = get_side_polygons(np.column_stack((x + shift_x, y + shift_y)),
+                                                  np.column_stack((x - shift_x, y - shift_y)), offsets, lines)
+    if round_edges:
+        vertices, polygon_offsets = add_end_caps(vertices, polygon_offsets, x, y, widths, offsets, lines)
 
-        patch = ax.fill_betweenx(y=y, x1=x1, x2=x2, alpha=1, linewidth=0, color='red')
+    profiling.count("width_polygons", len(polygon_offsets) - 1)
+    return get_polygons_path(vertices, polygon_offsets)
 
-    return patch
+
+def get_segment_line_width_vertices(x, y, widths):
+    """
+    Polygon of line width around line either horizontally or vertically
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if abs(x[0] - x[-1]) > abs(y[0] - y[-1]):
+        return np.column_stack((np.append(x, np.flip(x)), np.append(y + widths, np.flip(y - widths))))
+    return np.column_stack((np.append(x + widths, np.flip(x - widths)), np.append(y, np.flip(y))))
 
 
 # ---------------------------------------------------------------------------------
 # Equidistant
 
 def get_polygon_from_equidistant(x, y, widths):
+    """
+    Vertex array of the polygon between both equidistant sides of the line, None for less than 2 points
+    """
     x_eq, y_eq, x_eq2, y_eq2 = calculate_equidistant_coords(x, y, widths)
 
     if len(x_eq) < 2:
         return None
 
-    x = np.append(x_eq, np.flip(x_eq2))
-    y = np.append(y_eq, np.flip(y_eq2))
-    coords = list(zip(x, y))
+    return np.column_stack((np.append(x_eq, np.flip(x_eq2)), np.append(y_eq, np.flip(y_eq2))))
 
-    return mp_patches.Polygon(coords, closed=True)
 
+def get_polygons_from_equidistant(x, y, widths, offsets, round_edges: bool = True) -> Path:
+    """
+    Width polygons of many lines at once, the same as get_width_polygon creates
+    for each of them with equidistant=True, circles of round edges follow polygons of all lines
+    :param x: x coords of all lines concatenated
+    :param y: y coords of all lines concatenated
+    :param widths: width (in map distance) for each point
+    :param offsets: start of each line in x, y and widths, last item is their length
+    :return: compound path of all polygons, see get_polygons_path
+    """
+    with profiling.stage("equidistant_coords"):
+        x_eq, y_eq, x_eq2, y_eq2, eq_offsets = calculate_equidistant_coords_batch(x, y, widths, offsets)
+    lines = get_lines_with_width(widths, offsets)
 
-def calculate_equidistant_coords(x, y, distances):
-    # Mid points
-    x_m = []
-    y_m = []
-    d_m = []
-    k_m = []
-
-    # Calculate middle points:
-    for i in range(len(x) - 1):
-        y_m.append((y[i + 1] - y[i]) / 2.0 + y[i])
-        x_m.append((x[i + 1] - x[i]) / 2.0 + x[i])
-        d_m.append((distances[i + 1] - distances[i]) / 2.0 + distances[i])
-
-        if y[i + 1] == y[i]:
-            k_m.append(1e8)
-        else:
-            k_m.append(-(x[i + 1] - x[i]) / (y[i + 1] - y[i]))
-
-    # Add first elements
-    x_m.insert(0, x[0])
-    y_m.insert(0, y[0])
-    d_m.insert(0, distances[0])
-    k_m.insert(0, k_m[0])
-
-    # Add last elements
-    x_m.append(x[-1])
-    y_m.append(y[-1])
-    d_m.append(distances[-1])
-    k_m.append(k_m[-1])
-
-    # Convert into np.arrays
-    x_m = np.array(x_m)
-    y_m = np.array(y_m)
-    k_m = np.array(k_m)
-    d_m = np.array(d_m)
-
-    # Calculate equidistant points
-    x_eq = d_m * np.sqrt(1.0 / (1 + k_m ** 2))
-    x_eq2 = np.zeros_like(x_eq)
-    y_eq = np.zeros_like(x_eq)
-    y_eq2 = np.zeros_like(x_eq)
+    vertices, polygon_offsets = get_side_polygons(np.column_stack((x_eq, y_eq)), np.column_stack((x_eq2, y_eq2)),
+                                                  eq_offsets, lines)
+    if round_edges:
+        vertices, polygon_offsets = add_end_caps(vertices, polygon_offsets, x, y, widths, offsets, lines)
 
-    for i, x_shift in enumerate(x_eq):
-        x_eq[i] = x_m[i] - abs(x_shift)
-        x_eq2[i] = x_m[i] + abs(x_shift)
+    profiling.count("width_polygons", len(polygon_offsets) - 1)
+    return get_polygons_path(vertices, polygon_offsets)
 
-        y_eq[i] = (y_m[i] - k_m[i] * x_m[i]) + k_m[i] * x_eq[i]
-        y_eq2[i] = (y_m[i] - k_m[i] * x_m[i]) + k_m[i] * x_eq2[i]
 
-    # Switch lines that intersect the original line
-    original_line = LineString(zip(x, y))
+def calculate_equidistant_coords(x, y, distances):
+    x_eq, y_eq, x_eq2, y_eq2, _ = calculate_equidistant_coords_batch(x, y, distances, np.array([0, len(x)]))
+    return x_eq, y_eq, x_eq2, y_eq2
 
-    for i in range(1, len(x_eq)):
-        seg = LineString(zip(x_eq[i - 1:i + 1], y_eq[i - 1:i + 1]))
 
-        # try catch block
-        try:
-            if original_line.intersection(seg):
-                x_eq[i], x_eq2[i] = x_eq2[i], x_eq[i]
-                y_eq[i], y_eq2[i] = y_eq2[i], y_eq[i]
-        except RuntimeWarning:
-            print("warning lol")
+def calculate_equidistant_coords_batch(x, y, distances, offsets):
+    """
+    Points in given distances on both sides of many lines at once.
+    A line of n points gets n + 1 equidistant points on each side: shifted first point,
+    shifted midpoints of its parts and shifted last point.
+    :param x: x coords of all lines concatenated
+    :param y: y coords of all lines concatenated
+    :param distances: distance for each point
+    :param offsets: start of each line in x, y and distances, last item is their length
+    :return: coords of both sides, offsets of lines in them
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    distances = np.asarray(distances, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lines_count = len(offsets) - 1
+
+    # parts of lines (pairs of consecutive points of the same line)
+    in_line = np.ones(max(len(x) - 1, 0), dtype=bool)
+    in_line[offsets[1:-1] - 1] = False
+
+    dx = (x[1:] - x[:-1])[in_line]
+    dy = (y[1:] - y[:-1])[in_line]
+    part_x = (dx / 2.0 + x[:-1][in_line])
+    part_y = (dy / 2.0 + y[:-1][in_line])
+    part_d = ((distances[1:] - distances[:-1]) / 2.0 + distances[:-1])[in_line]
+    horizontal = dy == 0
+    part_k = np.where(horizontal, 1e8, -dx / np.where(horizontal, 1, dy))
+
+    # middle points with first and last point of each line
+    eq_offsets = offsets + np.arange(lines_count + 1)
+    first = eq_offsets[:-1]
+    last = eq_offsets[1:] - 1
+    middle = np.ones(eq_offsets[-1], dtype=bool)
+    middle[first] = False
+    middle[last] = False
+
+    part_offsets = offsets - np.arange(lines_count + 1)
+    first_part = part_offsets[:-1]
+    last_part = part_offsets[1:] - 1
+
+    x_m = np.empty(eq_offsets[-1])
+    y_m = np.empty_like(x_m)
+    d_m = np.empty_like(x_m)
+    k_m = np.empty_like(x_m)
+    dir_x = np.empty_like(x_m)
+    dir_y = np.empty_like(x_m)
+
+    for values, part_values, first_values, last_values in ((x_m, part_x, x[offsets[:-1]], x[offsets[1:] - 1]),
+                                                           (y_m, part_y, y[offsets[:-1]], y[offsets[1:] - 1]),
+                                                           (d_m, part_d, distances[offsets[:-1]],
+                                                            distances[offsets[1:] - 1]),
+                                                           (k_m, part_k, part_k[first_part], part_k[last_part]),
+                                                           (dir_x, dx, dx[first_part], dx[last_part]),
+                                                           (dir_y, dy, dy[first_part], dy[last_part])):
+        values[middle] = part_values
+        values[first] = first_values
+        values[last] = last_values
 
-    return x_eq, y_eq, x_eq2, y_eq2
+    # Calculate equidistant points
+    x_shift = np.abs(d_m * np.sqrt(1.0 / (1 + k_m ** 2)))
+    x_eq = x_m - x_shift
+    x_eq2 = x_m + x_shift
+    y_eq = (y_m - k_m * x_m) + k_m * x_eq
+    y_eq2 = (y_m - k_m * x_m) + k_m * x_eq2
+
+    # Keep each side of a line on the same side as its first point. The side is taken from the direction
+    # of the shift (-1, -k), not from the shifted point, which is the point itself where the distance is 0.
+    side = np.sign(dir_y - k_m * dir_x)
+    # a part of zero length has no side, the first point of the line with a side is the reference
+    counts = eq_offsets[1:] - eq_offsets[:-1]
+    with_side = np.where(side != 0, np.arange(len(side)), len(side))
+    reference = np.minimum.reduceat(with_side, first) if len(side) else with_side
+    reference_side = np.where(reference < len(side), side[np.minimum(reference, len(side) - 1)], 0)
+    switch = side * np.repeat(reference_side, counts) < 0
+
+    x_eq[switch], x_eq2[switch] = x_eq2[switch], x_eq[switch]
+    y_eq[switch], y_eq2[switch] = y_eq2[switch], y_eq[switch]
+
+    return x_eq, y_eq, x_eq2, y_eq2, eq_offsets
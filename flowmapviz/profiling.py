@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from time import perf_counter
+
+_profiler = None
+_disabled = nullcontext()
+
+
+class Profiler:
+    """
+    Wall time and call count of rendering stages and counters (segments, false segments) collected per frame.
+    A frame is one call of plot_routes or FlowFrameRenderer.update, stages outside of frames
+    (e.g. styling of the map by zoom) are only in totals.
+    """
+
+    def __init__(self):
+        self.frames = []
+        self.totals = _create_record()
+        self._frame = None
+
+    @contextmanager
+    def frame(self, name: str):
+        if self._frame is not None:
+            # nested frame is a part of the outer one
+            yield self._frame
+            return
+
+        record = _create_record(name)
+        self._frame = record
+        start = perf_counter()
+        try:
+            yield record
+        finally:
+            record["time"] = perf_counter() - start
+            self._frame = None
+            self.frames.append(record)
+
+    @contextmanager
+    def stage(self, name: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self._add_stage(name, perf_counter() - start)
+
+    def count(self, name: str, value: int = 1):
+        for record in self._get_records():
+            record["counters"][name] = record["counters"].get(name, 0) + int(value)
+
+    def to_dict(self) -> dict:
+        """
+        :return: totals of all stages and counters and the record of each frame
+        """
+        return {"totals": self.totals, "frames": self.frames}
+
+    def _add_stage(self, name, seconds):
+        for record in self._get_records():
+            stage = record["stages"].setdefault(name, {"time": 0.0, "calls": 0})
+            stage["time"] += seconds
+            stage["calls"] += 1
+
+    def _get_records(self):
+        if self._frame is None:
+            return self.totals,
+        return self.totals, self._frame
+
+
+@contextmanager
+def profile():
+    """
+    Collect timing of rendering stages while in the context
+
+        with profile() as profiler:
+            plot_routes(...)
+        record = profiler.to_dict()
+    """
+    global _profiler
+    previous, _profiler = _profiler, Profiler()
+    try:
+        yield _profiler
+    finally:
+        _profiler = previous
+
+
+def stage(name: str):
+    """
+    Context manager timing a stage of rendering, does nothing if profiling is not enabled
+    """
+    if _profiler is None:
+        return _disabled
+    return _profiler.stage(name)
+
+
+def count(name: str, value: int = 1):
+    """
+    Add value to a counter of the current frame, does nothing if profiling is not enabled
+    """
+    if _profiler is not None:
+        _profiler.count(name, value)
+
+
+def profiled_frame(function):
+    """
+    Decorator making each call of function a frame of the profile
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if _profiler is None:
+            return function(*args, **kwargs)
+        with _profiler.frame(function.__qualname__):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def _create_record(name: str = None):
+    record = {"stages": {}, "counters": {}}
+    if name is not None:
+        record = {"name": name, "time": 0.0, **record}
+    return record
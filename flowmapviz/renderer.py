@@ -0,0 +1,240 @@
+from __future__ import annotations
+
+import logging
+
+import networkx as nx
+import numpy as np
+
+from matplotlib.axes import Axes
+from matplotlib.collections import LineCollection
+from matplotlib.colors import Normalize
+from matplotlib.path import Path
+
+from . import profiling
+from .batch import gather_lines, get_color_scalars, get_line_widths, select_segments
+from .frame import DensityFrame
+from .geometry import EdgeGeometryIndex
+from .statistics import DensityStatistics
+from .plot import WidthStyle, create_width_collection, get_cmap, get_view_bounds, get_width_polygons
+from .zoom import get_zoom_level
+
+
+class FlowFrameRenderer:
+    """
+    Stateful alternative of plot_routes for consecutive frames.
+    Owns the collections in ax and updates them in place, so no artists are created or removed between frames.
+    Segments present in the previous frame keep their position in the collection,
+    segments leaving the frame are dropped and new segments are appended at the end.
+    Geometry is not touched at all if the set of plotted segments has not changed.
+
+    Style attributes have the same meaning as the parameters of plot_routes
+    and can be changed between frames.
+    """
+
+    def __init__(self,
+                 ax: Axes,
+                 g: nx.MultiDiGraph = None,
+                 geometry_index: EdgeGeometryIndex = None,
+                 min_density: int = 1, max_density: int = 10,
+                 min_width_density: int = 10, max_width_density: int = 50,
+                 default_linewidth: float = 3, width_modifier: float = 1,
+                 width_style: WidthStyle = WidthStyle.BOXED,
+                 round_edges: bool = True,
+                 roadtypes_by_zoom: bool = False, hidden_lines_width=1,
+                 keep_positions: bool = True,
+                 cull_to_view: bool = False, view_margin: float = 0.1,
+                 simplify: bool = False,
+                 animated: bool = False,
+                 statistics: DensityStatistics = None):
+        """
+        :param ax: layer for adding plotted shapes
+        :param g: Graph representation of base layer map, used only if geometry_index is not set
+        :param geometry_index: precomputed coordinates of edges of g
+        :param keep_positions: if False segments are always plotted in order of the frame
+            (as plot_routes does), so the result does not depend on previous frames
+        :param cull_to_view: if True skip segments outside of the view limits of ax
+        :param view_margin: margin around the view limits as a fraction of their size
+        :param simplify: if True use geometries simplified for the zoom level of ax
+        :param animated: if True the collections are animated, they are not drawn with the figure
+            and have to be drawn by draw (for blitting over a saved background)
+        :param statistics: statistics of the whole simulation, if set the density attributes are derived from it
+            (see DensityStatistics.get_density_limits)
+        """
+        self.ax = ax
+        self.geometry_index = geometry_index if geometry_index is not None else EdgeGeometryIndex.from_graph(g)
+
+        self.min_density = min_density
+        self.max_density = max_density
+        self.min_width_density = min_width_density
+        self.max_width_density = max_width_density
+        self.default_linewidth = default_linewidth
+        self.width_modifier = width_modifier
+        self.width_style = width_style
+        self.round_edges = round_edges
+        self.roadtypes_by_zoom = roadtypes_by_zoom
+        self.hidden_lines_width = hidden_lines_width
+        self.keep_positions = keep_positions
+        self.cull_to_view = cull_to_view
+        self.view_margin = view_margin
+        self.simplify = simplify
+        self.animated = animated
+        if statistics is not None:
+            (self.min_density, self.max_density,
+             self.min_width_density, self.max_width_density) = statistics.get_density_limits()
+
+        self.line_collection = None
+        self.patch_collection = None
+        self._edges = np.empty(0, dtype=np.int64)
+        self._plotted_index = None
+
+    @profiling.profiled_frame
+    def update(self,
+               nodes_from: list[int],
+               nodes_to: list[int],
+               densities: list[int] | list[list[int]]):
+        """
+        Replace the plotted frame with a new one
+        :return: LineCollection of color segments, PathCollection of width representation
+        """
+        if not (len(nodes_from) == len(nodes_to) and len(nodes_to) == len(densities)):
+            logging.error(f"Nodes_from, nodes_to and densities does not have the same length")
+            count = min(len(nodes_from), len(nodes_to), len(densities))
+            nodes_from, nodes_to, densities = nodes_from[:count], nodes_to[:count], densities[:count]
+
+        with profiling.stage("segments"):
+            frame = DensityFrame.from_lists(nodes_from, nodes_to, densities)
+        return self.update_frame(frame)
+
+    @profiling.profiled_frame
+    def update_frame(self, frame: DensityFrame):
+        """
+        Replace the plotted frame with a new one given as arrays, e.g. FrameStore.get_frame
+        :return: LineCollection of color segments, PathCollection of width representation
+        """
+        nodes_from, nodes_to, values, offsets = frame.nodes_from, frame.nodes_to, frame.values, frame.offsets
+
+        zoom_level = get_zoom_level(self.ax) if self.roadtypes_by_zoom else None
+        view = None
+        if self.cull_to_view:
+            view = get_view_bounds(self.ax, self.view_margin, self.default_linewidth + self.width_modifier)
+
+        geometry_index = self.geometry_index
+        if self.simplify:
+            with profiling.stage("simplify"):
+                geometry_index = geometry_index.get_simplified(get_zoom_level(self.ax))
+
+        with profiling.stage("segments"):
+            edges, styled, hidden, false_segments = select_segments(geometry_index, nodes_from, nodes_to,
+                                                                    zoom_level, self.hidden_lines_width, view)
+
+        profiling.count("segments", len(nodes_from))
+        profiling.count("styled_segments", len(styled))
+        profiling.count("false_segments", false_segments)
+        if false_segments:
+            logging.info(f"False segments: {false_segments} from {len(nodes_from)}")
+
+        if not len(styled):
+            self.clear()
+            return None, None
+
+        with profiling.stage("segments"):
+            segments = self._order_segments(edges, np.concatenate((styled, hidden)))
+            is_styled = np.isin(segments, styled)
+            segment_edges = edges[segments]
+
+            color_scalars = get_color_scalars(geometry_index, segment_edges, values, offsets, segments)
+            line_counts = np.diff(geometry_index.offsets)[segment_edges] - 1
+            line_widths = get_line_widths(color_scalars, self.min_width_density, self.max_width_density,
+                                          self.default_linewidth, self.width_modifier,
+                                          self.width_style == WidthStyle.BOXED)
+            line_widths[~np.repeat(is_styled, line_counts)] = self.hidden_lines_width
+
+        with profiling.stage("collections"):
+            coll = self._get_line_collection()
+            if geometry_index is not self._plotted_index or not np.array_equal(segment_edges, self._edges):
+                coll.set_segments(gather_lines(geometry_index, segment_edges))
+                self._edges = segment_edges
+                self._plotted_index = geometry_index
+            coll.set_array(color_scalars)
+            coll.set_linewidth(line_widths)
+            coll.set_norm(Normalize(self.min_density, self.max_density))
+            coll.set_capstyle('round' if self.round_edges else 'butt')
+            coll.set_visible(True)
+
+        path = None
+        if self.width_style in (WidthStyle.CALLIGRAPHY, WidthStyle.EQUIDISTANT):
+            with profiling.stage("width_polygons"):
+                path = get_width_polygons(self.ax, geometry_index, edges[styled], values, offsets, styled,
+                                          self.min_width_density, self.max_width_density, self.width_modifier,
+                                          equidistant=self.width_style == WidthStyle.EQUIDISTANT,
+                                          round_edges=self.round_edges)
+
+        with profiling.stage("collections"):
+            visible = path is not None and len(path.vertices) > 0
+            patch = self._get_patch_collection()
+            patch.set_paths([path] if visible else [])
+            patch.set_visible(visible)
+
+        return coll, patch if visible else None
+
+    def draw(self):
+        """
+        Draw the collections into the canvas of ax without drawing the rest of the figure,
+        the canvas must have been drawn before
+        """
+        # the same order as in Axes.draw
+        artists = [a for a in self.ax.collections if a is self.line_collection or a is self.patch_collection]
+        with profiling.stage("draw"):
+            for artist in sorted(artists, key=lambda a: a.get_zorder()):
+                self.ax.draw_artist(artist)
+
+    def clear(self):
+        """
+        Hide all plotted segments, the collections stay in ax for next frames
+        """
+        self._edges = np.empty(0, dtype=np.int64)
+        for coll in (self.line_collection, self.patch_collection):
+            if coll is not None:
+                coll.set_paths([])
+                coll.set_visible(False)
+
+    def remove(self):
+        """
+        Remove the collections from ax
+        """
+        for coll in (self.line_collection, self.patch_collection):
+            if coll is not None:
+                coll.remove()
+        self.line_collection = None
+        self.patch_collection = None
+        self._edges = np.empty(0, dtype=np.int64)
+
+    def _order_segments(self, edges, segments):
+        """
+        Order plotted segments so that segments of the previous frame keep their position
+        """
+        segment_edges = edges[segments]
+        if not self.keep_positions or not len(self._edges) or len(np.unique(segment_edges)) != len(segment_edges):
+            return segments
+
+        previous = self._edges[np.sort(np.unique(self._edges, return_index=True)[1])]
+        kept = previous[np.isin(previous, segment_edges)]
+        added = np.isin(segment_edges, kept, invert=True)
+
+        sorter = np.argsort(segment_edges)
+        kept_segments = segments[sorter[np.searchsorted(segment_edges, kept, sorter=sorter)]]
+        return np.concatenate((kept_segments, segments[added]))
+
+    def _get_line_collection(self):
+        if self.line_collection is None:
+            self.line_collection = LineCollection([], cmap=get_cmap(), animated=self.animated)
+            self.ax.add_collection(self.line_collection, autolim=False)
+        return self.line_collection
+
+    def _get_patch_collection(self):
+        if self.patch_collection is None:
+            self.patch_collection = create_width_collection(Path(np.empty((0, 2))))
+            self.patch_collection.set_facecolor(get_cmap()(1.0))
+            self.patch_collection.set_animated(self.animated)
+            self.ax.add_collection(self.patch_collection, autolim=False)
+        return self.patch_collection
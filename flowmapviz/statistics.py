@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+import logging
+import os
+
+from typing import BinaryIO
+from zipfile import BadZipFile
+
+import numpy as np
+
+from .batch import pack_densities
+
+DEFAULT_BINS = 256
+_CHUNK_VALUES = 2**24
+_ARRAYS = ("edges", "frame_min", "frame_max", "histograms")
+
+
+class DensityStatistics:
+    """
+    Statistics of densities of all frames of a simulation: histograms and the lowest and the highest density
+    of each frame. Global statistics and quantiles are derived from them without reading the densities again.
+    All frames share the same bins, edges spread evenly from the lowest to the highest density of the simulation.
+    """
+
+    def __init__(self, edges: np.ndarray, frame_min: np.ndarray, frame_max: np.ndarray, histograms: np.ndarray):
+        """
+        :param edges: edges of bins of the histograms, one more than bins
+        :param frame_min: the lowest density of each frame (nan for empty frames)
+        :param frame_max: the highest density of each frame (nan for empty frames)
+        :param histograms: numbers of densities in each bin, one row per frame
+        """
+        self.edges = edges
+        self.frame_min = frame_min
+        self.frame_max = frame_max
+        self.histograms = histograms
+        self.histogram = histograms.sum(axis=0)
+
+    @classmethod
+    def from_ragged(cls,
+                    values: np.ndarray,
+                    value_offsets: np.ndarray,
+                    frame_offsets: np.ndarray,
+                    bins: int = DEFAULT_BINS,
+                    low: float = None,
+                    high: float = None) -> DensityStatistics:
+        """
+        Statistics of frames stored as in FrameStore, computed by one pass over values when low and high are set
+        :param values: densities of all segments of all frames concatenated
+        :param value_offsets: start of each segment in values, last item is the end of the last segment
+        :param frame_offsets: start of each frame in segments, last item is the number of segments
+        :param bins: number of bins of the histograms
+        :param low: the lowest of values (e.g. min_count of FrameStore.statistics), read from values if not set
+        :param high: the highest of values (e.g. max_count of FrameStore.statistics), read from values if not set
+        """
+        frame_starts = np.asarray(value_offsets)[np.asarray(frame_offsets)]
+        frames_count = len(frame_starts) - 1
+        frame_min = np.full(frames_count, np.nan)
+        frame_max = np.full(frames_count, np.nan)
+        histograms = np.zeros((frames_count, bins), dtype=np.int64)
+
+        if frame_starts[-1] == frame_starts[0]:
+            low, high = 0.0, 0.0
+        elif low is None or high is None:
+            # the range of all values defines the bins, so it must be known before the histograms
+            values_range = values[frame_starts[0]:frame_starts[-1]]
+            low, high = float(np.min(values_range)), float(np.max(values_range))
+        edges = np.linspace(low, high if high > low else low + 1, bins + 1)
+
+        # frames are processed in chunks, memory-mapped values are read a chunk at a time
+        for first, last in _get_chunks(frame_starts):
+            chunk = np.asarray(values[frame_starts[first]:frame_starts[last]])
+            sizes = np.diff(frame_starts[first:last + 1])
+            filled = np.flatnonzero(sizes)
+            if len(filled):
+                starts = frame_starts[first:last][filled] - frame_starts[first]
+                frame_min[first + filled] = np.minimum.reduceat(chunk, starts)
+                frame_max[first + filled] = np.maximum.reduceat(chunk, starts)
+
+            value_bins = np.clip(((chunk - edges[0]) / (edges[-1] - edges[0]) * bins).astype(np.int64), 0, bins - 1)
+            frames = np.repeat(np.arange(last - first), sizes)
+            histograms[first:last] = np.bincount(frames * bins + value_bins,
+                                                 minlength=(last - first) * bins).reshape(-1, bins)
+
+        return cls(edges, frame_min, frame_max, histograms)
+
+    @classmethod
+    def from_times_dic(cls, times_dic: dict, bins: int = DEFAULT_BINS) -> DensityStatistics:
+        """
+        Statistics of frames of times_dic in order of their timestamps
+        """
+        # imported here, storage imports this module
+        from .storage import get_frame_data
+
+        values, value_offsets, frame_offsets = [], [np.zeros(1, dtype=np.int64)], [0]
+        values_count = 0
+        low, high = np.inf, -np.inf
+        for key in sorted(times_dic.keys()):
+            _, _, densities = get_frame_data(times_dic[key])
+            frame_values, offsets = pack_densities(densities)
+            values.append(frame_values)
+            value_offsets.append(offsets[1:] + values_count)
+            values_count += len(frame_values)
+            frame_offsets.append(frame_offsets[-1] + len(densities))
+            if len(frame_values):
+                low, high = min(low, frame_values.min()), max(high, frame_values.max())
+
+        values = np.concatenate(values) if values else np.empty(0)
+        value_offsets = np.concatenate(value_offsets)
+        return cls.from_ragged(values, value_offsets, np.asarray(frame_offsets), bins, low, high)
+
+    @classmethod
+    def load(cls, path: str) -> DensityStatistics:
+        """
+        Open statistics saved by save
+        """
+        with np.load(path) as arrays:
+            return cls(*(arrays[name] for name in _ARRAYS))
+
+    def save(self, file: str | BinaryIO):
+        """
+        Save the statistics into a .npz file
+        """
+        np.savez(file, **{name: getattr(self, name) for name in _ARRAYS})
+
+    def __len__(self):
+        return len(self.histograms)
+
+    @property
+    def min_count(self) -> float:
+        """
+        :return: the lowest density of all frames
+        """
+        return float(np.nanmin(self.frame_min)) if self.count else 0.0
+
+    @property
+    def max_count(self) -> float:
+        """
+        :return: the highest density of all frames
+        """
+        return float(np.nanmax(self.frame_max)) if self.count else 0.0
+
+    @property
+    def count(self) -> int:
+        """
+        :return: number of densities of all frames
+        """
+        return int(self.histogram.sum())
+
+    def quantile(self, q: float | np.ndarray, frame: int = None) -> float | np.ndarray:
+        """
+        Quantiles interpolated linearly inside the bins of the histogram
+        :param q: quantile or array of quantiles between 0 and 1
+        :param frame: if set, quantile of densities of this frame instead of all frames
+        """
+        histogram = self.histogram if frame is None else self.histograms[frame]
+        low = self.min_count if frame is None else self.frame_min[frame]
+        high = self.max_count if frame is None else self.frame_max[frame]
+        cumulative = np.cumsum(histogram)
+        if not cumulative[-1]:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+
+        targets = np.asarray(q, dtype=np.float64) * cumulative[-1]
+        bins = np.clip(np.searchsorted(cumulative, targets), 0, len(histogram) - 1)
+        before = np.where(bins > 0, cumulative[bins - 1], 0)
+        fractions = np.divide(targets - before, histogram[bins], out=np.zeros(np.shape(targets)),
+                              where=histogram[bins] > 0)
+        result = np.clip(self.edges[bins] + fractions * (self.edges[bins + 1] - self.edges[bins]), low, high)
+        return float(result) if np.ndim(result) == 0 else result
+
+    def get_density_limits(self, color_quantile: float = 0.95) -> tuple[float, float, float, float]:
+        """
+        Density parameters of plot_routes derived from the statistics, so all frames use the same scales.
+        Color spans densities from the lowest one to color_quantile (outliers do not flatten the gradient),
+        width grows from there to the highest density.
+        :return: min_density, max_density, min_width_density and max_width_density
+        """
+        min_density = self.min_count
+        max_density = max(self.quantile(color_quantile), min_density) if self.count else min_density
+        return min_density, max_density, max_density, max(self.max_count, max_density)
+
+
+def load_statistics(path: str, data_path: str, compute) -> DensityStatistics:
+    """
+    Statistics cached in path, computed by compute and saved when the cache is missing or older than data_path
+    :param path: .npz file of the cache
+    :param data_path: file or directory of the data the statistics are computed from
+    :param compute: function returning DensityStatistics
+    """
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(data_path):
+        try:
+            return DensityStatistics.load(path)
+        except (OSError, ValueError, KeyError, BadZipFile) as e:
+            logging.warning(f"Statistics cache {path} cannot be read: {e}")
+
+    statistics = compute()
+    # saved under a temporary name first, so a concurrent reader never opens a partial file
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            statistics.save(f)
+        os.replace(temp_path, path)
+    except OSError as e:
+        logging.warning(f"Statistics cannot be cached in {path}: {e}")
+    return statistics
+
+
+def get_density_statistics(data_path: str, source) -> DensityStatistics:
+    """
+    Statistics of a simulation loaded from data_path, cached next to a pickled times_dic
+    and computed again only when the pickle changes
+    :param data_path: directory of a FrameStore or a pickled times_dic
+    :param source: FrameStore or times_dic loaded from data_path
+    """
+    # imported here, storage imports this module
+    from .storage import FrameStore
+
+    if isinstance(source, FrameStore):
+        return source.density_statistics
+    return load_statistics(data_path + ".statistics.npz", data_path, lambda: DensityStatistics.from_times_dic(source))
+
+
+def _get_chunks(frame_starts):
+    """
+    :return: generator of ranges (first, last) of consecutive frames with about _CHUNK_VALUES densities,
+        a bigger frame is a chunk on its own
+    """
+    first = 0
+    while first < len(frame_starts) - 1:
+        last = int(np.searchsorted(frame_starts, frame_starts[first] + _CHUNK_VALUES, side="right")) - 1
+        last = min(max(last, first + 1), len(frame_starts) - 1)
+        yield first, last
+        first = last
@@ -0,0 +1,217 @@
+from __future__ import annotations
+
+import json
+import os
+
+import numpy as np
+
+from numpy.lib.format import open_memmap
+
+from .batch import pack_densities
+from .frame import DensityFrame
+from .statistics import DensityStatistics, load_statistics
+
+_ARRAYS = ("timestamps", "frame_offsets", "nodes_from", "nodes_to", "count_offsets", "counts")
+
+
+class FrameStore:
+    """
+    Segments of all frames of a simulation in flat columnar arrays saved as a directory of .npy files.
+    Opened memory-mapped, so frames are read from disk only when they are accessed.
+
+    Segments of frame i are nodes_from[frame_offsets[i]:frame_offsets[i + 1]] (and the same of nodes_to),
+    counts of segment s are counts[count_offsets[s]:count_offsets[s + 1]].
+    """
+
+    def __init__(self,
+                 timestamps: np.ndarray,
+                 frame_offsets: np.ndarray,
+                 nodes_from: np.ndarray,
+                 nodes_to: np.ndarray,
+                 count_offsets: np.ndarray,
+                 counts: np.ndarray,
+                 statistics: dict = None):
+        """
+        :param timestamps: sorted timestamps of frames
+        :param frame_offsets: start of each frame in segments, last item is the number of segments
+        :param nodes_from: OSM id defining starting nodes of segments of all frames
+        :param nodes_to: OSM id defining ending nodes of segments of all frames
+        :param count_offsets: start of each segment in counts, last item is the length of counts
+        :param counts: numbers of cars of all segments concatenated
+        :param statistics: precomputed statistics of counts, see create
+        """
+        self.timestamps = timestamps
+        self.frame_offsets = frame_offsets
+        self.nodes_from = nodes_from
+        self.nodes_to = nodes_to
+        self.count_offsets = count_offsets
+        self.counts = counts
+        self.statistics = statistics if statistics is not None else get_statistics(counts)
+        self.path = None
+        self._density_statistics = None
+
+    @classmethod
+    def create(cls, path: str, times_dic: dict) -> FrameStore:
+        """
+        Write frames of times_dic into a new store and open it
+        :param path: directory of the store
+        :param times_dic: segments of each frame (dicts with node_from, node_to and counts) by timestamp
+        """
+        keys = sorted(times_dic.keys())
+        timestamps = np.asarray(keys)
+        if timestamps.dtype == object:
+            timestamps = np.asarray(keys, dtype="datetime64[ns]")
+
+        # sizes and the type of arrays are found first, so frames are written directly into the files
+        frame_offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        counts_count = 0
+        counts_type = np.int32
+        for i, key in enumerate(keys):
+            _, _, densities = get_frame_data(times_dic[key])
+            values, _ = pack_densities(densities)
+            frame_offsets[i + 1] = frame_offsets[i] + len(densities)
+            counts_count += len(values)
+            # counts are int32 unless a frame has densities that are not integers
+            counts_type = np.promote_types(counts_type, values.dtype)
+
+        os.makedirs(path, exist_ok=True)
+        segments_count = int(frame_offsets[-1])
+        np.save(os.path.join(path, "timestamps.npy"), timestamps)
+        np.save(os.path.join(path, "frame_offsets.npy"), frame_offsets)
+        nodes_from = open_memmap(os.path.join(path, "nodes_from.npy"), "w+", np.int64, (segments_count,))
+        nodes_to = open_memmap(os.path.join(path, "nodes_to.npy"), "w+", np.int64, (segments_count,))
+        count_offsets = open_memmap(os.path.join(path, "count_offsets.npy"), "w+", np.int64, (segments_count + 1,))
+        counts = open_memmap(os.path.join(path, "counts.npy"), "w+", counts_type, (counts_count,))
+
+        count_offsets[0] = 0
+        for i, key in enumerate(keys):
+            frame_from, frame_to, densities = get_frame_data(times_dic[key])
+            start, end = frame_offsets[i], frame_offsets[i + 1]
+            values, offsets = pack_densities(densities)
+
+            nodes_from[start:end] = frame_from
+            nodes_to[start:end] = frame_to
+            count_offsets[start + 1:end + 1] = offsets[1:] + count_offsets[start]
+            counts[count_offsets[start]:count_offsets[end]] = values
+
+        statistics = get_statistics(counts)
+        for array in (nodes_from, nodes_to, count_offsets, counts):
+            array.flush()
+        with open(os.path.join(path, "metadata.json"), "w") as f:
+            json.dump({"statistics": statistics}, f)
+        DensityStatistics.from_ragged(counts, count_offsets, frame_offsets, low=statistics["min_count"],
+                                      high=statistics["max_count"]).save(os.path.join(path, "statistics.npz"))
+
+        return cls.load(path)
+
+    @classmethod
+    def from_pickle(cls, path: str, pickle_path: str) -> FrameStore:
+        """
+        Convert simulation data pickled by FlowMapVideo into a new store and open it
+        :param path: directory of the store
+        :param pickle_path: pickled times_dic
+        """
+        import pandas as pd
+        return cls.create(path, pd.read_pickle(pickle_path))
+
+    @classmethod
+    def load(cls, path: str, mmap_mode: str = "r") -> FrameStore:
+        """
+        Open a store created by create. With mmap_mode the arrays are memory-mapped read-only
+        and pickling the store passes only its path.
+        """
+        with open(os.path.join(path, "metadata.json")) as f:
+            metadata = json.load(f)
+        arrays = [np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode) for name in _ARRAYS]
+
+        store = cls(*arrays, statistics=metadata["statistics"])
+        if mmap_mode is not None:
+            store.path = path
+        return store
+
+    def __reduce__(self):
+        if self.path is not None:
+            return self.load, (self.path,)
+        return self.__class__, tuple(getattr(self, name) for name in _ARRAYS) + (self.statistics,)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, i: int) -> tuple[np.ndarray, np.ndarray, list[np.ndarray]]:
+        """
+        :return: nodes_from, nodes_to and densities of segments of frame i
+        """
+        nodes_from, nodes_to, values, offsets = self.get_packed(i)
+        if not len(nodes_from):
+            return nodes_from, nodes_to, []
+        return nodes_from, nodes_to, np.split(values, offsets[1:-1])
+
+    def get_packed(self, i: int) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :return: nodes_from, nodes_to, densities of frame i as flat values and offsets (see pack_densities)
+        """
+        if i < 0:
+            i += len(self)
+        start, end = self.frame_offsets[i], self.frame_offsets[i + 1]
+        count_offsets = self.count_offsets[start:end + 1]
+        values = self.counts[count_offsets[0]:count_offsets[-1]]
+        return self.nodes_from[start:end], self.nodes_to[start:end], values, count_offsets - count_offsets[0]
+
+    def get_frame(self, i: int) -> DensityFrame:
+        """
+        :return: segments of frame i as views into the columns of the store
+        """
+        return DensityFrame(*self.get_packed(i))
+
+    @property
+    def max_count(self):
+        """
+        :return: the highest number of cars of all frames
+        """
+        return self.statistics["max_count"]
+
+    @property
+    def density_statistics(self) -> DensityStatistics:
+        """
+        :return: histograms and ranges of counts of each frame, computed on the first access
+            and cached as statistics.npz in the directory of the store
+        """
+        if self._density_statistics is None:
+            def compute():
+                return DensityStatistics.from_ragged(self.counts, self.count_offsets, self.frame_offsets,
+                                                     low=self.statistics["min_count"],
+                                                     high=self.statistics["max_count"])
+
+            if self.path is None:
+                self._density_statistics = compute()
+            else:
+                self._density_statistics = load_statistics(os.path.join(self.path, "statistics.npz"),
+                                                           os.path.join(self.path, "counts.npy"), compute)
+        return self._density_statistics
+
+
+def get_statistics(counts: np.ndarray) -> dict:
+    """
+    :return: global statistics of counts of all frames
+    """
+    return {
+        "min_count": float(counts.min()) if len(counts) else 0.0,
+        "max_count": float(counts.max()) if len(counts) else 0.0,
+        "counts": int(len(counts)),
+    }
+
+
+def get_frame_data(segments):
+    """
+    :return: nodes_from, nodes_to and densities of segments of one frame
+    """
+    nodes_from, nodes_to, densities = [], [], []
+    for segment in segments:
+        if type(segment) is tuple:
+            node_from, node_to, counts = segment[:3]
+        else:
+            node_from, node_to, counts = segment['node_from'], segment['node_to'], segment['counts']
+        nodes_from.append(node_from)
+        nodes_to.append(node_to)
+        densities.append(counts)
+    return nodes_from, nodes_to, densities
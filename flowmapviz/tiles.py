@@ -0,0 +1,296 @@
+from __future__ import annotations
+
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator
+
+import networkx as nx
+import numpy as np
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.image import imsave
+
+from . import profiling
+from .frame import DensityFrame
+from .geometry import EdgeGeometryIndex
+from .plot import plot_frame
+from .video import share_geometry_index
+from .zoom import get_highway_styles, get_map_aspect, plot_edges, style_edges
+
+_worker = {}
+
+
+class TileGrid:
+    """
+    Square extent of a map split into 2**z x 2**z square tiles at zoom z.
+    Tiles are numbered as XYZ tiles (x from the west, y from the north), in the coordinates of the map.
+    """
+
+    def __init__(self, x_min: float, y_max: float, width: float, aspect: float = 1.0):
+        """
+        :param x_min: west edge of the extent
+        :param y_max: north edge of the extent
+        :param width: size of the extent in x, its size in y is width / aspect
+        :param aspect: aspect of the map (see get_map_aspect), so the tiles are square on the screen
+        """
+        self.x_min = x_min
+        self.y_max = y_max
+        self.width = width
+        self.aspect = aspect
+
+    @classmethod
+    def from_index(cls, geometry_index: EdgeGeometryIndex, padding: float = 0.02) -> TileGrid:
+        """
+        Grid covering all edges of the index
+        :param padding: padding around the edges as a fraction of their size, the same as plot_graph_with_zoom adds
+        """
+        bounds = geometry_index.get_map_bounds()
+        (left, bottom), (right, top) = bounds[:, :2].min(axis=0), bounds[:, 2:].max(axis=0)
+        aspect = get_map_aspect(geometry_index.crs, bottom, top)
+
+        width = max(right - left, (top - bottom) * aspect) * (1 + 2 * padding) or 1.0
+        x_center, y_center = (left + right) / 2, (bottom + top) / 2
+        return cls(x_center - width / 2, y_center + width / aspect / 2, width, aspect)
+
+    def get_tile_size(self, zoom: int) -> tuple[float, float]:
+        """
+        :return: size of tiles at zoom in x and y
+        """
+        width = self.width / 2 ** zoom
+        return width, width / self.aspect
+
+    def get_tile_bounds(self, zoom: int, x: int, y: int) -> tuple[float, float, float, float]:
+        """
+        :return: min x, min y, max x, max y of the tile
+        """
+        width, height = self.get_tile_size(zoom)
+        left, top = self.x_min + x * width, self.y_max - y * height
+        return left, top - height, left + width, top
+
+    def get_tiles(self, bounds: np.ndarray, zoom: int, margin: tuple[float, float] = (0, 0)) \
+            -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Grid used as a spatial index, items are assigned to all tiles their bounding box intersects
+        :param bounds: bounding boxes of items as an array of shape (N, 4) with min x, min y, max x, max y
+        :param zoom: zoom level of tiles
+        :param margin: bounding boxes are extended by this distance in x and y
+        :return: x and y of tiles and the index of the item for each pair of an item and its tile
+        """
+        count = 2 ** zoom
+        width, height = self.get_tile_size(zoom)
+        x_from = np.clip(np.floor((bounds[:, 0] - margin[0] - self.x_min) / width), 0, count - 1).astype(np.int64)
+        x_to = np.clip(np.floor((bounds[:, 2] + margin[0] - self.x_min) / width), 0, count - 1).astype(np.int64)
+        y_from = np.clip(np.floor((self.y_max - bounds[:, 3] - margin[1]) / height), 0, count - 1).astype(np.int64)
+        y_to = np.clip(np.floor((self.y_max - bounds[:, 1] + margin[1]) / height), 0, count - 1).astype(np.int64)
+
+        columns = x_to - x_from + 1
+        tiles_count = columns * (y_to - y_from + 1)
+        items = np.repeat(np.arange(len(bounds)), tiles_count)
+        starts = np.zeros(len(bounds), dtype=np.int64)
+        np.cumsum(tiles_count[:-1], out=starts[1:])
+        steps = np.arange(len(items)) - starts[items]
+        return x_from[items] + steps % columns[items], y_from[items] + steps // columns[items], items
+
+
+def render_tiles(frame: DensityFrame,
+                 output_dir: str,
+                 g: nx.MultiDiGraph = None,
+                 zooms: Iterable[int] = range(4),
+                 tile_size: int = 256,
+                 dpi: float = 100,
+                 processes: int = None,
+                 geometry_index: EdgeGeometryIndex = None,
+                 grid: TileGrid = None,
+                 default_linewidth: float = 3, width_modifier: float = 1,
+                 **plot_kwargs) -> list[str]:
+    """
+    Render a frame as a pyramid of PNG tiles saved as output_dir/z/x/y.png, tiles without any edge are skipped.
+    Each tile is rendered on its own small canvas from the edges and segments near it, so memory does not grow
+    with the size of the map. All tiles of a zoom level have the same scale, so zoom level styling
+    and widths in points are the same in all of them and lines continue across their borders.
+    :param frame: segments and their densities
+    :param output_dir: directory of the pyramid
+    :param g: Graph representation of base layer map, may be None if geometry_index is set
+    :param zooms: zoom levels of the pyramid, zoom z has 2**z x 2**z tiles
+    :param tile_size: size of tiles in pixels
+    :param dpi: resolution of tiles, widths in points are converted to pixels with it
+    :param processes: number of worker processes, defaults to the number of CPUs, 1 renders in this process
+    :param geometry_index: precomputed coordinates of edges of g
+    :param grid: extent of the pyramid, defaults to the extent of all edges
+    :param plot_kwargs: style parameters of plot_routes
+    :return: paths of saved tiles
+    """
+    if geometry_index is None:
+        geometry_index = EdgeGeometryIndex.from_graph(g)
+    grid = grid or TileGrid.from_index(geometry_index)
+    plot_kwargs = dict(plot_kwargs, default_linewidth=default_linewidth, width_modifier=width_modifier)
+
+    tasks = (task for zoom in zooms
+             for task in _iter_tasks(geometry_index, grid, frame, zoom, tile_size, dpi, plot_kwargs))
+    return [path for _, _, _, path in _iter_rendered(tasks, geometry_index, processes,
+                                                     (grid, tile_size, dpi, plot_kwargs, output_dir))]
+
+
+def render_tiled_image(frame: DensityFrame,
+                       zoom: int,
+                       g: nx.MultiDiGraph = None,
+                       tile_size: int = 256,
+                       dpi: float = 100,
+                       processes: int = None,
+                       geometry_index: EdgeGeometryIndex = None,
+                       grid: TileGrid = None,
+                       default_linewidth: float = 3, width_modifier: float = 1,
+                       **plot_kwargs) -> np.ndarray:
+    """
+    Render a frame in tiles of one zoom level of render_tiles in parallel and stitch them into one image,
+    e.g. for output larger than a single canvas can render (zoom 5 with 256 px tiles is 8192 px wide)
+    :return: RGBA array of the tiles covering the map, tiles without any edge are white
+    """
+    if geometry_index is None:
+        geometry_index = EdgeGeometryIndex.from_graph(g)
+    grid = grid or TileGrid.from_index(geometry_index)
+    plot_kwargs = dict(plot_kwargs, default_linewidth=default_linewidth, width_modifier=width_modifier)
+
+    tasks = list(_iter_tasks(geometry_index, grid, frame, zoom, tile_size, dpi, plot_kwargs))
+    if not tasks:
+        return np.full((0, 0, 4), 255, dtype=np.uint8)
+    tiles_x = np.array([task[1] for task in tasks])
+    tiles_y = np.array([task[2] for task in tasks])
+    x_from, y_from = tiles_x.min(), tiles_y.min()
+
+    image = np.full(((tiles_y.max() - y_from + 1) * tile_size, (tiles_x.max() - x_from + 1) * tile_size, 4),
+                    255, dtype=np.uint8)
+    for _, x, y, tile in _iter_rendered(tasks, geometry_index, processes, (grid, tile_size, dpi, plot_kwargs, None)):
+        top, left = (y - y_from) * tile_size, (x - x_from) * tile_size
+        image[top:top + tile_size, left:left + tile_size] = tile
+    return image
+
+
+def _iter_tasks(geometry_index, grid, frame, zoom, tile_size, dpi, plot_kwargs):
+    """
+    :return: generator of (zoom, x, y, edges, map edges, frame) of tiles of zoom with at least one edge of the map,
+        edges and segments of the frame are assigned to tiles with a margin of the widest line
+    """
+    width, height = grid.get_tile_size(zoom)
+    line_width = (plot_kwargs["default_linewidth"] + plot_kwargs["width_modifier"]) * dpi / 72 / tile_size
+    margin = (width * line_width, height * line_width)
+
+    with profiling.stage("tiles"):
+        # every edge is one of the edges of the map, tiles with an edge or a segment have an edge of the map
+        map_keys, map_edges = _group_by_tile(grid, geometry_index.get_map_bounds(), zoom, margin)
+        keys, starts = np.unique(map_keys, return_index=True)
+        tile_map_edges = np.split(map_edges, starts[1:])
+
+        bounds = geometry_index.get_bounds()
+        edge_keys, edges = _group_by_tile(grid, bounds, zoom, margin)
+        edge_starts = np.searchsorted(edge_keys, keys)
+        edge_ends = np.searchsorted(edge_keys, keys, side="right")
+
+        segment_edges = geometry_index.lookup(frame.nodes_from, frame.nodes_to)
+        found = np.flatnonzero(segment_edges >= 0)
+        segment_keys, segments = _group_by_tile(grid, bounds[segment_edges[found]], zoom, margin)
+        segments = found[segments]
+        segment_starts = np.searchsorted(segment_keys, keys)
+        segment_ends = np.searchsorted(segment_keys, keys, side="right")
+
+    for key, tile_map, edge_start, edge_end, start, end in zip(keys.tolist(), tile_map_edges, edge_starts, edge_ends,
+                                                                segment_starts, segment_ends):
+        yield (zoom, key // 2 ** zoom, key % 2 ** zoom, edges[edge_start:edge_end], tile_map,
+               _select_segments(frame, segments[start:end]))
+
+
+def _group_by_tile(grid, bounds, zoom, margin):
+    """
+    :return: keys of tiles and the items assigned to them, sorted by the key and the item
+    """
+    tiles_x, tiles_y, items = grid.get_tiles(bounds, zoom, margin)
+    keys = tiles_x * 2 ** zoom + tiles_y
+    order = np.lexsort((items, keys))
+    return keys[order], items[order]
+
+
+def _select_segments(frame, segments):
+    """
+    :return: frame of only the given segments
+    """
+    starts = frame.offsets[segments]
+    counts = frame.offsets[segments + 1] - starts
+    offsets = np.zeros(len(segments) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    values = frame.values[np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1])]
+    return DensityFrame(frame.nodes_from[segments], frame.nodes_to[segments], values, offsets)
+
+
+def _iter_rendered(tasks, geometry_index, processes, init_args) -> Iterator[tuple[int, int, int, object]]:
+    """
+    :return: generator of (zoom, x, y, RGBA array or path) of rendered tasks in their order
+    """
+    processes = processes or os.cpu_count() or 1
+    if processes == 1:
+        _init_worker(geometry_index, *init_args)
+        try:
+            yield from map(_render_tile, tasks)
+        finally:
+            # the index is not kept alive by this module after the tiles are rendered
+            _worker.clear()
+        return
+
+    # a bounded number of tiles is rendered ahead of the consumer, as in render_stream
+    with tempfile.TemporaryDirectory() as shared_dir:
+        geometry_index = share_geometry_index(geometry_index, shared_dir)
+        with ProcessPoolExecutor(processes, initializer=_init_worker,
+                                 initargs=(geometry_index, *init_args)) as executor:
+            pending = deque()
+            for task in tasks:
+                if len(pending) >= 4 * processes:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(_render_tile, task))
+
+            while pending:
+                yield pending.popleft().result()
+
+
+def _init_worker(geometry_index, grid, tile_size, dpi, plot_kwargs, output_dir):
+    _worker['geometry_index'] = geometry_index
+    _worker['grid'] = grid
+    _worker['tile_size'] = tile_size
+    _worker['dpi'] = dpi
+    _worker['plot_kwargs'] = plot_kwargs
+    _worker['output_dir'] = output_dir
+
+
+def _render_tile(task):
+    zoom, x, y, edges, map_edges, frame = task
+    tile_size, dpi = _worker['tile_size'], _worker['dpi']
+    # only edges near the tile are plotted, lookups of its segments find them all
+    geometry_index = _worker['geometry_index'].select(edges, map_edges)
+
+    fig = Figure(figsize=(tile_size / dpi, tile_size / dpi), dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes((0, 0, 1, 1))
+    with profiling.stage("map_plot"):
+        plot_edges(geometry_index, ax)
+    # limits of the tile have the aspect of the grid, so the axes fill the whole tile
+    x_min, y_min, x_max, y_max = _worker['grid'].get_tile_bounds(zoom, x, y)
+    ax.set_aspect("auto")
+    ax.set_xlim(x_min, x_max)
+    ax.set_ylim(y_min, y_max)
+    # styled by the zoom level of the tile, styles of the whole index are cached for all tiles of the worker
+    style_edges(ax, get_highway_styles(_worker['geometry_index']), edges=map_edges)
+
+    if len(frame):
+        plot_frame(None, ax, frame, geometry_index=geometry_index, **_worker['plot_kwargs'])
+    with profiling.stage("draw"):
+        fig.canvas.draw()
+    image = np.asarray(fig.canvas.buffer_rgba())
+
+    output_dir = _worker['output_dir']
+    if output_dir is None:
+        return zoom, x, y, image.copy()
+    path = os.path.join(output_dir, str(zoom), str(x), f"{y}.png")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    imsave(path, image)
+    return zoom, x, y, path
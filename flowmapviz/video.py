@@ -0,0 +1,298 @@
+from __future__ import annotations
+
+import os
+import subprocess
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Iterable, Iterator
+
+import networkx as nx
+import numpy as np
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.image import imsave
+
+from . import profiling
+from .background import BackgroundCache
+from .frame import DensityFrame
+from .geometry import EdgeGeometryIndex
+from .renderer import FlowFrameRenderer
+from .storage import FrameStore, get_frame_data
+from .zoom import plot_graph_with_zoom
+
+_worker = {}
+
+
+def render_frames(g: nx.MultiDiGraph,
+                  times_dic: dict | FrameStore,
+                  output_dir: str = None,
+                  processes: int = None,
+                  chunk_size: int = None,
+                  figsize: tuple[float, float] = (8, 8),
+                  dpi: float = 100,
+                  geometry_index: EdgeGeometryIndex = None,
+                  **plot_kwargs):
+    """
+    Render frames of a simulation in parallel, each process renders ranges of consecutive frames
+    on its own Agg canvas
+    :param g: Graph representation of base layer map, may be None if geometry_index is set
+    :param times_dic: segments of each frame (dicts with node_from, node_to and counts) by timestamp
+        or a FrameStore, workers then read frames from the memory-mapped store
+    :param output_dir: if set, frames are saved there as numbered PNGs instead of being returned
+    :param processes: number of worker processes, defaults to the number of CPUs
+    :param chunk_size: number of consecutive frames rendered by one task
+    :param figsize: size of the figure in inches
+    :param dpi: resolution of the figure
+    :param geometry_index: precomputed coordinates of edges of g, workers get it memory-mapped
+        instead of a copy of the graph
+    :param plot_kwargs: style parameters of plot_routes
+    :return: RGBA arrays of frames or paths of saved PNGs, in order of timestamps
+    """
+    frame_store = times_dic if isinstance(times_dic, FrameStore) else None
+    if frame_store is not None:
+        frames = [(i, None) for i in range(len(frame_store))]
+    else:
+        frames = [(i, times_dic[key]) for i, key in enumerate(sorted(times_dic.keys()))]
+    if not frames:
+        return []
+
+    processes = processes or os.cpu_count() or 1
+    if chunk_size is None:
+        chunk_size = max(1, -(-len(frames) // (processes * 4)))
+    chunks = [frames[i:i + chunk_size] for i in range(0, len(frames), chunk_size)]
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    if geometry_index is None:
+        geometry_index = EdgeGeometryIndex.from_graph(g)
+
+    if processes == 1:
+        _init_worker(geometry_index, frame_store, figsize, dpi, plot_kwargs, output_dir, len(frames))
+        try:
+            return [frame for chunk in map(_render_chunk, chunks) for frame in chunk]
+        finally:
+            # the figure, the renderer and the frame store are not kept alive by this module
+            _worker.clear()
+
+    with tempfile.TemporaryDirectory() as shared_dir:
+        geometry_index = share_geometry_index(geometry_index, shared_dir)
+        init_args = (geometry_index, frame_store, figsize, dpi, plot_kwargs, output_dir, len(frames))
+        with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=init_args) as executor:
+            results = list(executor.map(_render_chunk, chunks))
+
+    return [frame for chunk in results for frame in chunk]
+
+
+def iter_frames(source: FrameStore | str | dict, start: int = 0, stop: int = None) \
+        -> Iterator[tuple[object, DensityFrame]]:
+    """
+    Read frames of a simulation lazily one by one
+    :param source: FrameStore, directory of a saved FrameStore or times_dic
+    :param start: index of the first frame
+    :param stop: index after the last frame
+    :return: generator of (timestamp, DensityFrame) of frames in order of timestamps
+    """
+    if isinstance(source, str):
+        source = FrameStore.load(source)
+
+    if isinstance(source, FrameStore):
+        for i in range(len(source))[start:stop]:
+            yield source.timestamps[i], source.get_frame(i)
+    else:
+        for key in sorted(source.keys())[start:stop]:
+            yield key, DensityFrame.from_lists(*get_frame_data(source[key]))
+
+
+def render_stream(frames: Iterable[tuple],
+                  g: nx.MultiDiGraph = None,
+                  processes: int = None,
+                  chunk_size: int = 4,
+                  max_in_flight: int = None,
+                  figsize: tuple[float, float] = (8, 8),
+                  dpi: float = 100,
+                  geometry_index: EdgeGeometryIndex = None,
+                  **plot_kwargs) -> Iterator[tuple[object, np.ndarray]]:
+    """
+    Render frames as they come, only a bounded number of frames is read ahead of the consumer,
+    so memory does not grow with the length of the simulation
+    :param frames: iterable of (timestamp, DensityFrame), see iter_frames,
+        or of (timestamp, nodes_from, nodes_to, densities)
+    :param g: Graph representation of base layer map, may be None if geometry_index is set
+    :param processes: number of worker processes, defaults to the number of CPUs, 1 renders in this process
+    :param chunk_size: number of consecutive frames rendered by one task
+    :param max_in_flight: maximal number of tasks submitted and not yet consumed, defaults to 2 * processes
+    :param figsize: size of the figure in inches
+    :param dpi: resolution of the figure
+    :param geometry_index: precomputed coordinates of edges of g
+    :param plot_kwargs: style parameters of plot_routes
+    :return: generator of (timestamp, RGBA array) of frames in order of frames
+    """
+    if geometry_index is None:
+        geometry_index = EdgeGeometryIndex.from_graph(g)
+    processes = processes or os.cpu_count() or 1
+    chunks = _iter_chunks(frames, chunk_size)
+
+    if processes == 1:
+        _init_worker(geometry_index, None, figsize, dpi, plot_kwargs, None, 1)
+        try:
+            for timestamps, chunk in chunks:
+                yield from zip(timestamps, _render_chunk(chunk))
+        finally:
+            # also when the consumer stops early and the generator is closed
+            _worker.clear()
+        return
+
+    max_in_flight = max_in_flight or 2 * processes
+    with tempfile.TemporaryDirectory() as shared_dir:
+        geometry_index = share_geometry_index(geometry_index, shared_dir)
+        init_args = (geometry_index, None, figsize, dpi, plot_kwargs, None, 1)
+        with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=init_args) as executor:
+            pending = deque()
+            for timestamps, chunk in chunks:
+                # wait for the oldest task before reading more frames
+                if len(pending) >= max_in_flight:
+                    yield from _collect(*pending.popleft())
+                pending.append((timestamps, executor.submit(_render_chunk, chunk)))
+
+            while pending:
+                yield from _collect(*pending.popleft())
+
+
+def save_frames(frames: Iterable[tuple[object, np.ndarray]], output_dir: str, name_width: int = 6) -> list[str]:
+    """
+    Sink of render_stream saving frames as numbered PNGs
+    :return: paths of saved frames
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for i, (_, image) in enumerate(frames):
+        path = os.path.join(output_dir, f"{i:0{name_width}d}.png")
+        imsave(path, image)
+        paths.append(path)
+    return paths
+
+
+def encode_video(frames: Iterable[tuple[object, np.ndarray]],
+                 path: str,
+                 fps: float = 25,
+                 ffmpeg: str = "ffmpeg",
+                 codec_args: tuple[str, ...] = ("-c:v", "libx264", "-pix_fmt", "yuv420p")) -> int:
+    """
+    Sink of render_stream piping raw frames into ffmpeg
+    :param path: output video file
+    :param fps: frames per second of the video
+    :param ffmpeg: ffmpeg executable
+    :param codec_args: output arguments of ffmpeg
+    :return: number of encoded frames
+    """
+    process = None
+    count = 0
+    try:
+        for _, image in frames:
+            if process is None:
+                height, width = image.shape[:2]
+                process = subprocess.Popen(
+                    [ffmpeg, "-y", "-loglevel", "error",
+                     "-f", "rawvideo", "-pix_fmt", "rgba", "-s", f"{width}x{height}", "-r", str(fps), "-i", "-",
+                     # yuv420p needs even dimensions
+                     "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", *codec_args, path],
+                    stdin=subprocess.PIPE)
+            process.stdin.write(np.ascontiguousarray(image).tobytes())
+            count += 1
+    finally:
+        if process is not None:
+            process.stdin.close()
+            process.wait()
+
+    if process is not None and process.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed with exit code {process.returncode}")
+    return count
+
+
+def share_geometry_index(geometry_index: EdgeGeometryIndex, shared_dir: str) -> EdgeGeometryIndex:
+    """
+    Memory-mapped index is pickled as its path, so worker processes share its pages instead of copying it
+    :param shared_dir: directory for saving the index if it is not memory-mapped yet
+    """
+    if geometry_index.path is None:
+        geometry_index.save(shared_dir)
+        geometry_index = EdgeGeometryIndex.load(shared_dir)
+    return geometry_index
+
+
+def create_canvas(g: nx.MultiDiGraph,
+                  figsize: tuple[float, float] = (8, 8),
+                  dpi: float = 100,
+                  geometry_index: EdgeGeometryIndex = None):
+    """
+    Offscreen figure with the base map, densities are plotted into the same ax above the map
+    :return: figure, ax with the map
+    """
+    fig = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes((0, 0, 1, 1))
+    ax = plot_graph_with_zoom(g, ax, geometry_index=geometry_index)
+    # fix view limits before the first frame, widths in points depend on them
+    ax.apply_aspect()
+    return fig, ax
+
+
+def _init_worker(geometry_index, frame_store, figsize, dpi, plot_kwargs, output_dir, frames_count):
+    fig, ax = create_canvas(None, figsize, dpi, geometry_index=geometry_index)
+    _worker['fig'] = fig
+    # frames must not depend on how they are split between workers
+    _worker['renderer'] = FlowFrameRenderer(ax, geometry_index=geometry_index, keep_positions=False, animated=True,
+                                            **plot_kwargs)
+    # the map does not change between frames, it is drawn once and only densities are drawn over it
+    _worker['background'] = BackgroundCache(ax)
+    _worker['frame_store'] = frame_store
+    _worker['output_dir'] = output_dir
+    _worker['name_width'] = len(str(frames_count - 1))
+
+
+def _render_chunk(chunk):
+    fig = _worker['fig']
+    renderer = _worker['renderer']
+    frame_store = _worker['frame_store']
+    output_dir = _worker['output_dir']
+
+    results = []
+    for i, frame in chunk:
+        if frame is None:
+            frame = frame_store.get_frame(i)
+        elif type(frame) is tuple:
+            frame = DensityFrame.from_lists(*frame)
+        elif not isinstance(frame, DensityFrame):
+            frame = DensityFrame.from_lists(*get_frame_data(frame))
+        renderer.update_frame(frame)
+        background = _worker['background']
+        if not background.restore():
+            with profiling.stage("background"):
+                fig.canvas.draw()
+                background.capture()
+        renderer.draw()
+        image = np.asarray(fig.canvas.buffer_rgba())
+
+        if output_dir is None:
+            results.append(image.copy())
+        else:
+            path = os.path.join(output_dir, f"{i:0{_worker['name_width']}d}.png")
+            imsave(path, image)
+            results.append(path)
+
+    return results
+
+
+def _iter_chunks(frames, chunk_size):
+    frames = iter(frames)
+    while chunk := list(islice(frames, chunk_size)):
+        timestamps = [frame[0] for frame in chunk]
+        yield timestamps, [(i, frame[1] if len(frame) == 2 else tuple(frame[1:])) for i, frame in enumerate(chunk)]
+
+
+def _collect(timestamps, future):
+    return zip(timestamps, future.result())
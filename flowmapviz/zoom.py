@@ -1,9 +1,23 @@
+from __future__ import annotations
+
 import networkx as nx
-import osmnx as ox
+import numpy as np
 
 from enum import Enum, unique
-from matplotlib import pyplot as plt
+from typing import TYPE_CHECKING
+from weakref import WeakKeyDictionary
 from matplotlib.axes import Axes
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_rgba_array
+from pyproj import CRS
+
+from . import profiling
+
+if TYPE_CHECKING:
+    from .geometry import EdgeGeometryIndex
+
+# highway styles of plotted graphs and geometry indices
+_highway_styles = WeakKeyDictionary()
 
 
 @unique
@@ -28,7 +42,7 @@ class ZoomLevel(Enum):
 def get_zoom_level(ax) -> ZoomLevel:
     lims = ax.get_xlim()
     lims = lims[1] - lims[0]
-    window_size = ax.get_window_extent().transformed(plt.gcf().dpi_scale_trans.inverted()).size
+    window_size = ax.get_window_extent().transformed(ax.figure.dpi_scale_trans.inverted()).size
     ratio = lims / window_size[0]
     ratio = ratio * 111 * 39370.0787
     for zoom_level in ZoomLevel:
@@ -69,7 +83,47 @@ def plot_graph_with_zoom(g: nx.MultiDiGraph,
                          color_primary="dimgray",
                          size_primary: float = 1,
                          secondary_colors: list = None,
-                         secondary_sizes: list = None):
+                         secondary_sizes: list = None,
+                         geometry_index: EdgeGeometryIndex = None):
+    """
+    Plot the road network into ax (if not already plotted) and style its edges by the zoom level of ax
+    :param g: Graph representation of base layer map, may be None if geometry_index is set
+    :param geometry_index: if set, edges are plotted from the index instead of the graph
+    """
+    # check if graph has already been plotted
+    if ax is None:
+        from matplotlib import pyplot as plt
+        ax = plt.gca()
+
+    lines = ax.collections
+    if not lines:
+        with profiling.stage("map_plot"):
+            if geometry_index is not None:
+                plot_edges(geometry_index, ax)
+            else:
+                import osmnx as ox
+                _, ax = ox.plot_graph(g, ax=ax, node_size=0, show=False)
+
+    lines = ax.collections
+    if not lines:
+        return ax
+
+    styles = get_highway_styles(geometry_index) if geometry_index is not None else get_highway_styles(g)
+    return style_edges(ax, styles, color_primary, size_primary, secondary_colors, secondary_sizes)
+
+
+def style_edges(ax: Axes,
+                styles: HighwayStyles,
+                color_primary="dimgray",
+                size_primary: float = 1,
+                secondary_colors: list = None,
+                secondary_sizes: list = None,
+                edges: np.ndarray = None):
+    """
+    Style the plotted edges (the first collection of ax) by the zoom level of ax
+    :param styles: highway styles of the plotted edges, or of the edges they were selected from
+    :param edges: if set, the plotted edges are these edges of styles
+    """
     # check if secondary colors and sizes are correct length
     if secondary_sizes is None:
         secondary_sizes = [1, 0.5, 0.1]
@@ -84,18 +138,6 @@ def plot_graph_with_zoom(g: nx.MultiDiGraph,
         add = [secondary_sizes[-1] for _ in range(len(ZoomLevel) - len(secondary_sizes))]
         secondary_sizes.extend(add)
 
-    # check if graph has already been plotted
-    if ax is None:
-        ax = plt.gca()
-
-    lines = ax.collections
-    if not lines:
-        _, ax = ox.plot_graph(g, ax=ax, node_size=0, show=False)
-
-    lines = ax.collections
-    if not lines:
-        return ax
-
     # get zoom level
     zoom_level = get_zoom_level(ax)
 
@@ -104,28 +146,143 @@ def plot_graph_with_zoom(g: nx.MultiDiGraph,
         ax.collections[0].set_linewidth(size_primary)
         return ax
 
-    # get colors and sizes for each edge in graph
-    e_colors = []
-    e_sizes = []
-    for u, v, k, d in g.edges(keys=True, data=True):
-        if type(d['highway']) is list:
-            d['highway'] = d['highway'][0]
-
-        if d['highway'] in get_highway_types(zoom_level):
-            e_colors.append(color_primary)
-            e_sizes.append(size_primary)
-        else:
-            colored = False
-            for i, zoom in enumerate(zoom_level.get_smaller_zooms()):
-                if d['highway'] in get_highway_types(zoom):
-                    e_colors.append(secondary_colors[i])
-                    e_sizes.append(secondary_sizes[i])
-                    colored = True
-                    break
-            if not colored:
-                e_colors.append('white')
-                e_sizes.append(1)
-
-    ax.collections[0].set_color(e_colors)
-    ax.collections[0].set_linewidth(e_sizes)
+    with profiling.stage("map_styling"):
+        colors, sizes = styles.get(zoom_level, color_primary, size_primary, secondary_colors, secondary_sizes)
+        if edges is not None:
+            colors, sizes = colors[edges], sizes[edges]
+        ax.collections[0].set_color(colors)
+        ax.collections[0].set_linewidth(sizes)
     return ax
+
+
+def get_highway_style(highway: str,
+                      zoom_level: ZoomLevel,
+                      color_primary,
+                      size_primary: float,
+                      secondary_colors: list,
+                      secondary_sizes: list):
+    """
+    :return: color and width of an edge with the highway type at zoom_level
+    """
+    if highway in get_highway_types(zoom_level):
+        return color_primary, size_primary
+
+    for i, zoom in enumerate(zoom_level.get_smaller_zooms()):
+        if highway in get_highway_types(zoom):
+            return secondary_colors[i], secondary_sizes[i]
+
+    return 'white', 1
+
+
+def get_highway_class(highway):
+    """
+    :return: highway type of an edge, the first one if the edge has more of them
+    """
+    if type(highway) is list:
+        return highway[0]
+    return highway
+
+
+class HighwayStyles:
+    """
+    Highway class of every plotted edge with colors and widths of edges cached by zoom level,
+    so a zoom change only assigns ready-made arrays to the collection
+    """
+
+    def __init__(self, highway: np.ndarray, highway_classes: tuple[str, ...]):
+        """
+        :param highway: index of the highway class of each edge in order of plotting, -1 if the edge has none
+        :param highway_classes: names of highway classes
+        """
+        self.highway = highway
+        self.highway_classes = tuple(highway_classes)
+        self._styles = {}
+
+    @classmethod
+    def from_graph(cls, g: nx.MultiDiGraph) -> HighwayStyles:
+        """
+        :param g: Graph representation of base layer map, edges are in order of osmnx.plot_graph
+        """
+        highway_names = [get_highway_class(d.get('highway')) for _, _, d in g.edges(data=True)]
+        highway_classes = sorted({h for h in highway_names if h is not None})
+        class_codes = {h: i for i, h in enumerate(highway_classes)}
+        highway = np.array([class_codes.get(h, -1) for h in highway_names], dtype=np.int32)
+        return cls(highway, tuple(highway_classes))
+
+    def __len__(self):
+        return len(self.highway)
+
+    def get(self,
+            zoom_level: ZoomLevel,
+            color_primary,
+            size_primary: float,
+            secondary_colors: list,
+            secondary_sizes: list) -> tuple[np.ndarray, np.ndarray]:
+        """
+        :return: RGBA colors and widths of all edges at zoom_level
+        """
+        key = (zoom_level, str(color_primary), size_primary,
+               tuple(map(str, secondary_colors)), tuple(secondary_sizes))
+        styles = self._styles.get(key)
+        if styles is None:
+            # edges without highway (-1) get the style of the last item
+            class_styles = [get_highway_style(h, zoom_level, color_primary, size_primary,
+                                              secondary_colors, secondary_sizes)
+                            for h in self.highway_classes + (None,)]
+            colors, sizes = zip(*class_styles)
+            styles = (to_rgba_array(colors)[self.highway], np.array(sizes, dtype=np.float64)[self.highway])
+            self._styles[key] = styles
+        return styles
+
+
+def get_highway_styles(source: nx.MultiDiGraph | EdgeGeometryIndex) -> HighwayStyles:
+    """
+    :param source: plotted graph or geometry index
+    :return: highway styles of edges of source (of the map of a geometry index), computed once and cached
+        while source exists
+    """
+    styles = _highway_styles.get(source)
+    if isinstance(source, nx.MultiDiGraph):
+        if styles is None or len(styles) != source.number_of_edges():
+            styles = HighwayStyles.from_graph(source)
+            _highway_styles[source] = styles
+    elif styles is None:
+        styles = HighwayStyles(source.map_highway, source.highway_classes)
+        _highway_styles[source] = styles
+    return styles
+
+
+def plot_edges(geometry_index: EdgeGeometryIndex, ax: Axes, color="#999999", linewidth: float = 1):
+    """
+    Plot edges of the map of the index (parallel edges included) into ax the same way as osmnx.plot_graph does
+    """
+    # plain array, slices of a memory-mapped one are much slower to create
+    coords = np.asarray(geometry_index.map_coords)
+    segments = np.split(coords, geometry_index.map_offsets[1:-1])
+    ax.add_collection(LineCollection(segments, colors=color, linewidths=linewidth, zorder=1), autolim=False)
+
+    # view limits of the edges with 2% padding
+    (left, bottom), (right, top) = coords.min(axis=0), coords.max(axis=0)
+    padding_ns = (top - bottom) * 0.02
+    padding_ew = (right - left) * 0.02
+    ax.set_ylim((bottom - padding_ns, top + padding_ns))
+    ax.set_xlim((left - padding_ew, right + padding_ew))
+
+    ax.margins(0)
+    ax.tick_params(which="both", direction="in")
+    for spine in ax.spines.values():
+        spine.set_visible(False)
+    ax.get_xaxis().set_visible(False)
+    ax.get_yaxis().set_visible(False)
+
+    ax.set_aspect(get_map_aspect(geometry_index.crs, bottom, top))
+    return ax
+
+
+def get_map_aspect(crs: str | None, bottom: float, top: float) -> float:
+    """
+    :return: aspect of axes showing a map with crs between bottom and top, the same as osmnx.plot_graph sets
+    """
+    if crs is not None and CRS.from_user_input(crs).is_projected:
+        return 1.0
+    return 1 / np.cos(np.deg2rad((bottom + top) / 2))
@@ -16,9 +16,9 @@ class Ax_settings:
         ax.set_aspect(self.aspect)
 
 
-def twin_axes(g):
+def twin_axes(geometry_index):
     f, ax_map = plt.subplots()
-    ax_map = plot_graph_with_zoom(g, ax_map)
+    ax_map = plot_graph_with_zoom(None, ax_map, geometry_index=geometry_index)
     ax_density = ax_map.twinx()
     settings = Ax_settings(ylim=ax_map.get_ylim(), aspect=ax_map.get_aspect())
     settings.apply(ax_density)
@@ -0,0 +1,70 @@
+import os
+
+import click
+
+from time import time
+
+from flowmapviz.geometry import CACHE_DIR, load_graphml_index
+from flowmapviz.keyframes import iter_keyframes
+from flowmapviz.plot import WidthStyle
+from flowmapviz.statistics import get_density_statistics
+from flowmapviz.storage import FrameStore
+from flowmapviz.video import iter_frames, render_stream, encode_video, save_frames
+
+
+@click.command()
+@click.argument('map-file', type=click.Path(exists=True))
+@click.argument('segments-file', type=click.Path(exists=True))
+@click.argument('output', type=click.Path())
+@click.option('--frames-dir', is_flag=True, default=False,
+              help='if set, frames are saved as PNGs into OUTPUT directory instead of a video')
+@click.option('--fps', type=float, default=25, help='frames per second of the video')
+@click.option('--interpolate', type=int, default=1,
+              help='number of frames from one simulation frame to the next one, frames between them are blended')
+@click.option('--processes', type=int, default=None, help='number of rendering processes, defaults to CPU count')
+@click.option('--start', type=int, default=0, help='index of the first exported frame')
+@click.option('--stop', type=int, default=None, help='index after the last exported frame')
+@click.option('--width-style', type=click.Choice([s.name for s in WidthStyle]), default='EQUIDISTANT')
+@click.option('--width-modif', type=float, default=10, help='width of segments with the highest density (in points)')
+@click.option('--figsize', type=(float, float), default=(16, 9), help='size of the video in inches')
+@click.option('--dpi', type=float, default=120, help='resolution of the video')
+@click.option('--ffmpeg', default='ffmpeg', help='ffmpeg executable')
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=CACHE_DIR,
+              help='directory of cached maps, the map file is parsed only on its first use')
+@click.option('--no-cache', is_flag=True, default=False, help='if set, the map file is always parsed')
+def main(map_file, segments_file, output, frames_dir, fps, interpolate, processes, start, stop, width_style,
+         width_modif, figsize, dpi, ffmpeg, cache_dir, no_cache):
+    """
+    Render frames of SEGMENTS-FILE (pickle or frame store directory) over MAP-FILE into OUTPUT video
+    without opening a window
+    """
+    print('Loading data.')
+    if os.path.isdir(segments_file):
+        source = FrameStore.load(segments_file)
+    else:
+        import pandas as pd
+        source = pd.read_pickle(segments_file)
+    statistics = get_density_statistics(segments_file, source)
+
+    geometry_index = load_graphml_index(map_file, None if no_cache else cache_dir)
+
+    frames = iter_frames(source, start, stop)
+    if interpolate > 1:
+        frames = iter_keyframes(frames, interpolate)
+    images = render_stream(frames, processes=processes, figsize=figsize, dpi=dpi, geometry_index=geometry_index,
+                           statistics=statistics, width_modifier=width_modif, width_style=WidthStyle[width_style],
+                           round_edges=False)
+
+    print('Rendering.')
+    start_time = time()
+    if frames_dir:
+        count = len(save_frames(images, output))
+    else:
+        count = encode_video(images, output, fps=fps, ffmpeg=ffmpeg)
+    duration = time() - start_time
+
+    print(f'{count} frames in {duration:.1f} s, {count / duration if duration else 0:.1f} frames per second')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,6 @@
 import os
 
 import matplotlib.pyplot as plt
-import pandas as pd
-import osmnx as ox
 import click
 import importlib.resources as pkg_resources
 
@@ -12,10 +10,16 @@ from matplotlib.widgets import Slider
 from datetime import datetime
 from time import time
 
-from flowmapviz.plot import plot_routes, WidthStyle
+from flowmapviz.background import BackgroundCache
+from flowmapviz.plot import WidthStyle
+from flowmapviz.frame import DensityFrame
+from flowmapviz.geometry import CACHE_DIR, load_graphml_index
+from flowmapviz.renderer import FlowFrameRenderer
+from flowmapviz.statistics import get_density_statistics
+from flowmapviz.storage import FrameStore, get_frame_data
 from flowmapviz.zoom import plot_graph_with_zoom, get_zoom_level
 
-from .ax_settings import twin_axes, Ax_settings
+from .ax_settings import twin_axes
 
 rcParams['keymap.back'].remove('left')
 rcParams['keymap.forward'].remove('right')
@@ -31,18 +35,6 @@ def create_sliders(max_time, max_width, width_init):
     return time_slider, width_slider
 
 
-def get_max(times_dic):
-    max_count = 0
-    for key, time_data in times_dic.items():
-        for segment in time_data:
-            if type(segment) == tuple:
-                segment_max = max(segment[2])
-            else:
-                segment_max = max(segment['counts'])
-            max_count = max(segment_max, max_count)
-    return max_count
-
-
 def display_help():
     text = pkg_resources.read_text(__package__, 'README.md')
     print('\n' + '-' * 80)
@@ -53,32 +45,51 @@ def display_help():
 @click.command()
 @click.argument('map-file', type=click.Path(exists=True))
 @click.argument('segments-file', type=click.Path(exists=True))
+@click.option('--store', type=click.Path(file_okay=False), default=None,
+              help='convert the pickled segments file into a frame store in this directory and use it')
 @click.option('--width-in-map-distance', is_flag=True, default=False,
               help='if set, width is in map distance, otherwise in points')
 @click.option('--moving-slider', is_flag=True, default=False,
               help='if set, time slider will move during video generating')
-def main(map_file, segments_file, width_in_map_distance, moving_slider=False, width_style="EQUIDISTANT", width_modif=10):
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=CACHE_DIR,
+              help='directory of cached maps, the map file is parsed only on its first use')
+@click.option('--no-cache', is_flag=True, default=False, help='if set, the map file is always parsed')
+def main(map_file, segments_file, width_in_map_distance, store=None, moving_slider=False, width_style="EQUIDISTANT",
+         width_modif=10, cache_dir=CACHE_DIR, no_cache=False):
     print('Loading data.')
-    # read data saved from FlowMapVideo repository
-    times_dic = pd.read_pickle(segments_file)
+    if os.path.isdir(segments_file):
+        # frame store is memory-mapped, frames are read when displayed
+        times_dic = FrameStore.load(segments_file)
+    elif store is not None:
+        times_dic = FrameStore.from_pickle(store, segments_file)
+    else:
+        # read data saved from FlowMapVideo repository
+        import pandas as pd
+        times_dic = pd.read_pickle(segments_file)
 
-    # load graph
-    g = ox.load_graphml(map_file)
+    statistics = get_density_statistics(segments_file, times_dic)
+
+    # load map
+    geometry_index = load_graphml_index(map_file, None if no_cache else cache_dir)
 
     # create slider window
-    SliderWindow(g, times_dic, width_style, width_modif, width_in_map_distance, moving_slider).execute()
+    SliderWindow(geometry_index, times_dic, statistics, width_style, width_modif, width_in_map_distance,
+                 moving_slider).execute()
     print('Closing...')
 
 
 class SliderWindow:
-    def __init__(self, g, times_dic, width_style, width_modif, width_in_map_distance, moving_slider):
+    def __init__(self, geometry_index, times_dic, statistics, width_style, width_modif, width_in_map_distance,
+                 moving_slider):
         self.times_dic = times_dic
-        self.keys = list(sorted(self.times_dic.keys()))
-
-        self.max_count = get_max(self.times_dic)
-        print('Max number of cars: ', self.max_count)
-
-        self.g = g
+        if isinstance(times_dic, FrameStore):
+            self.keys = list(range(len(times_dic)))
+        else:
+            self.keys = list(sorted(self.times_dic.keys()))
+        self.statistics = statistics
+        print('Max number of cars: ', statistics.max_count)
+
+        self.geometry_index = geometry_index
         self.width_style = WidthStyle[width_style]
         self.round_edges = False
         self.roadtypes_by_zoom = False
@@ -91,16 +102,25 @@ class SliderWindow:
         self.last_zoom_level = None
         self.ax_map = None
         self.ax_density = None
+        self.renderer = None
+        self.background = None
         self.time_pid = None
 
     def execute(self):
-        f, self.ax_density, self.ax_map = twin_axes(self.g)
+        f, self.ax_density, self.ax_map = twin_axes(self.geometry_index)
         self.last_zoom_level = get_zoom_level(self.ax_density)
+        self.renderer = FlowFrameRenderer(self.ax_density, geometry_index=self.geometry_index,
+                                          statistics=self.statistics, animated=True)
+        self.background = BackgroundCache(self.ax_map)
 
-        # add sliders
+        # add sliders, they are not part of the cached background and are redrawn with densities
         self.time_slider, self.width_slider = create_sliders(len(self.keys), 100, self.width_modif)
+        for slider in (self.time_slider, self.width_slider):
+            slider.drawon = False
+            slider.ax.set_animated(True)
 
         f.canvas.mpl_connect('key_press_event', self.on_press)
+        f.canvas.mpl_connect('draw_event', self.on_draw)
         self.time_pid = self.time_slider.on_changed(self.update)
         self.width_slider.on_changed(self.width_update)
         self.ax_map.callbacks.connect('xlim_changed', self.on_lim_changed)
@@ -109,11 +129,34 @@ class SliderWindow:
         display_help()
         plt.show()
 
+    def on_draw(self, event):
+        # savefig draws the animated artists too, its canvas is not a background
+        if event.canvas.is_saving():
+            return
+        # the whole figure was drawn without densities and sliders, it is the background of the current view
+        self.background.capture()
+        self.draw_animated()
+
+    def draw_animated(self):
+        f = self.ax_map.figure
+        f.draw_artist(self.time_slider.ax)
+        f.draw_artist(self.width_slider.ax)
+        self.renderer.draw()
+
+    def draw_frame(self):
+        f = self.ax_map.figure
+        if self.background.restore():
+            self.draw_animated()
+            f.canvas.blit(f.bbox)
+        else:
+            f.canvas.draw_idle()
+        f.canvas.flush_events()
+
     def on_lim_changed(self, ax):
         new_zoom_level = get_zoom_level(ax)
         if new_zoom_level != self.last_zoom_level:
             print("set: ", new_zoom_level)
-            plot_graph_with_zoom(self.g, self.ax_map)
+            plot_graph_with_zoom(None, self.ax_map, geometry_index=self.geometry_index)
             self.last_zoom_level = new_zoom_level
             if self.roadtypes_by_zoom:
                 self.update()
@@ -151,18 +194,12 @@ class SliderWindow:
         if val is None:
             val = self.time_slider.val
 
-        settings = Ax_settings(ylim=self.ax_density.get_ylim(), aspect=self.ax_density.get_aspect())
-        self.ax_density.clear()
-        settings.apply(self.ax_density)
-        self.ax_density.axis('off')
-
         if val < 0:
+            self.renderer.clear()
+            self.draw_frame()
             return
 
-        segments = self.times_dic[self.keys[val]]
-        nodes_from = [s['node_from'] for s in segments]
-        nodes_to = [s['node_to'] for s in segments]
-        densities = [s['counts'] for s in segments]
+        frame = self.get_frame(val)
 
         start = datetime.now()
 
@@ -171,25 +208,21 @@ class SliderWindow:
         if self.width_in_map_distance:
             width, _ = map_distance_to_point_units(width / 1000, self.ax_density)
 
-        line_col, poly_col = plot_routes(self.g,
-                                         ax=self.ax_density,
-                                         nodes_from=nodes_from,
-                                         nodes_to=nodes_to,
-                                         densities=densities,
-                                         min_density=2, max_density=10,
-                                         min_width_density=10, max_width_density=self.max_count,
-                                         width_modifier=width,
-                                         width_style=self.width_style,
-                                         round_edges=self.round_edges,
-                                         roadtypes_by_zoom=self.roadtypes_by_zoom)
-
-        f = plt.gcf()
-        f.canvas.draw_idle()
-        f.canvas.flush_events()
+        self.renderer.width_modifier = width
+        self.renderer.width_style = self.width_style
+        self.renderer.round_edges = self.round_edges
+        self.renderer.roadtypes_by_zoom = self.roadtypes_by_zoom
+        line_col, poly_col = self.renderer.update_frame(frame)
+        self.draw_frame()
 
         finish = datetime.now()
         print(val, finish - start)
 
+    def get_frame(self, val):
+        if isinstance(self.times_dic, FrameStore):
+            return self.times_dic.get_frame(val)
+        return DensityFrame.from_lists(*get_frame_data(self.times_dic[self.keys[val]]))
+
     def width_update(self, val):
         if self.time_slider.val > -1:
             self.update()
@@ -14,7 +14,8 @@ setup(
     include_package_data=True,
     entry_points={
         "console_scripts": [
-            "flowmapviz-example = flowmapviz_example.slider:main"
+            "flowmapviz-example = flowmapviz_example.slider:main",
+            "flowmapviz-export = flowmapviz_example.export:main"
         ]
     }
 )